@@ -0,0 +1,100 @@
+"""Бенчмарк памяти снимка каталога.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_memory.py             # 50000 объявлений
+    python benchmarks/bench_memory.py --size 200000
+
+Объявления страниц-образцов из benchmarks/fixtures (сгенерированных, а не
+снятых с сайтов) размножаются до --size штук (ссылки делаются уникальными)
+и хранятся двумя способами: словарями с собственными копиями
+строк, как их раньше возвращал парсер, и записями Listing с интернированными
+строками. Для каждого способа tracemalloc измеряет память самих объявлений
+и готового CatalogSnapshot с индексами. Сеть не используется.
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parsers  # noqa: E402
+from catalog import CatalogSnapshot, Listing  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+FIXTURES = {
+    'antiqcar_market.html': parsers.ANTIQCAR,
+    'antarmotors_market.html': parsers.ANTARMOTORS,
+}
+
+
+def sample_listings():
+    cars = []
+    for name, spec in FIXTURES.items():
+        with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+            cars.extend(parsers.extract_cars(f.read(), spec))
+    return [car.to_dict() for car in cars]
+
+
+def fresh(value):
+    # Отдельная копия строки, как после get_text() каждой карточки
+    return ''.join(list(value)) if isinstance(value, str) else value
+
+
+def make_dicts(samples, size):
+    cars = []
+    for i in range(size):
+        car = {key: fresh(value) for key, value in samples[i % len(samples)].items()}
+        car['link'] = f"{car['link']}#{i}"
+        cars.append(car)
+    return cars
+
+
+def make_listings(samples, size):
+    cars = []
+    for i in range(size):
+        car = {key: fresh(value) for key, value in samples[i % len(samples)].items()}
+        car['link'] = f"{car['link']}#{i}"
+        cars.append(Listing(**car))
+    return cars
+
+
+def measure(build):
+    """(память объявлений, память снимка с индексами) в байтах"""
+    gc.collect()
+    tracemalloc.start()
+    cars = build()
+    listings = tracemalloc.get_traced_memory()[0]
+    snapshot = CatalogSnapshot(cars)
+    total = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del snapshot, cars
+    return listings, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=50000, help='число объявлений')
+    args = parser.parse_args()
+
+    samples = sample_listings()
+    print(f"Объявлений: {args.size} (из {len(samples)} образцов)")
+    print(f"{'представление':<24}{'объявления, МБ':>16}{'снимок, МБ':>12}{'байт/объявл.':>14}")
+
+    results = {}
+    for name, build in (('dict', make_dicts), ('Listing', make_listings)):
+        listings, total = measure(lambda: build(samples, args.size))
+        results[name] = listings, total
+        print(f"{name:<24}{listings / 2 ** 20:>16.1f}{total / 2 ** 20:>12.1f}{listings / args.size:>14.0f}")
+
+    (dict_listings, dict_total), (compact_listings, compact_total) = results['dict'], results['Listing']
+    print(f"\nЭкономия: объявления {1 - compact_listings / dict_listings:.0%}, снимок {1 - compact_total / dict_total:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
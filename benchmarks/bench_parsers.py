@@ -0,0 +1,196 @@
+"""Офлайн-бенчмарк парсеров каталога на страницах-образцах.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_parsers.py                    # сравнить с baseline.json
+    python benchmarks/bench_parsers.py --update-baseline  # записать новый baseline
+
+Страницы в benchmarks/fixtures - не снимки живых сайтов, а сгенерированные
+реконструкции разметки antiqcar.ru и antarmotors.ru: названия и номера моделей
+в них повторяются по кругу, нет пагинации и постороннего шума разметки.
+Эталонный результат разбора поэтому проверяет разбор этой разметки и не
+гарантирует, что парсер справится с текущими страницами сайтов.
+
+Для каждой страницы-образца и для синтетических страниц из тысяч карточек измеряются время разбора, карточек в секунду и пиковая
+память. Результат разбора сравнивается с эталоном, время и память - с baseline
+с допуском --tolerance, год выпуска для названий из YEAR_CASES - с ожидаемым. При регрессии скрипт завершается с кодом 1.
+Сеть не используется.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parsers  # noqa: E402
+from catalog import dump_listings  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+# Страницы-образцы: файл -> источник
+FIXTURES = {
+    'antiqcar_market.html': parsers.ANTIQCAR,
+    'antarmotors_market.html': parsers.ANTARMOTORS,
+}
+
+SYNTHETIC_SIZES = (1000, 5000)
+
+# Названия с номерами моделей, похожими на год: название -> ожидаемый год
+YEAR_CASES = {
+    'BMW 2002': None,
+    'BMW 2002 tii': None,
+    'BMW 2002 1972': 1972,
+    'BMW 2002 (1973)': 1973,
+    'ГАЗ 21 1960 г.': 1960,
+    'Cadillac Cabriolet 1966': 1966,
+    'Peugeot 2008 2021': 2021,
+}
+
+CARD_RE = re.compile(r'<div class="flex-item[^"]*".*?\n  </div>', re.S)
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def synthetic_page(html, size):
+    """Страница из size карточек, собранная повторением карточек страницы-образца"""
+    cards = CARD_RE.findall(html)
+    head = html[:html.index(cards[0])]
+    tail = html[html.rindex(cards[-1]) + len(cards[-1]):]
+
+    body = []
+    for i in range(size):
+        # Делаем ссылки уникальными, как на настоящей длинной странице
+        body.append(cards[i % len(cards)].replace('href="', f'href="/p{i // len(cards)}', 1))
+    return head + '\n'.join(body) + tail
+
+
+def cases():
+    for name, spec in FIXTURES.items():
+        html = read_fixture(name)
+        yield f"{name}", html, spec, len(CARD_RE.findall(html))
+        for size in SYNTHETIC_SIZES:
+            yield f"{name}x{size}", synthetic_page(html, size), spec, size
+
+
+def digest(cars):
+    data = dump_listings(cars, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def measure(html, spec, repeat):
+    timings = []
+    cars = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cars = parsers.extract_cars(html, spec)
+        timings.append(time.perf_counter() - started)
+
+    # Память меряем отдельным прогоном: tracemalloc заметно замедляет разбор
+    tracemalloc.start()
+    parsers.extract_cars(html, spec)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return cars, min(timings), statistics.median(timings), peak
+
+
+def expected_path(name):
+    return os.path.join(FIXTURES_DIR, name.replace('.html', '.expected.json'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update-baseline', action='store_true', help='записать текущие результаты как эталон')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='допустимое замедление/рост памяти относительно baseline')
+    parser.add_argument('--repeat', type=int, default=5, help='число прогонов каждого случая')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH) and not args.update_baseline:
+        with open(BASELINE_PATH, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print(f"Бэкенд парсера: {parsers.PARSER_BACKEND}")
+    print(f"{'случай':<36}{'карточек':>9}{'найдено':>9}{'лучшее, мс':>12}{'медиана, мс':>13}{'карт./с':>10}{'пик, КБ':>10}")
+
+    results = {}
+    failures = []
+    for name, html, spec, size in cases():
+        cars, best, median, peak = measure(html, spec, args.repeat)
+        results[name] = {
+            'cards': size,
+            'found': len(cars),
+            'digest': digest(cars),
+            'best_ms': round(best * 1000, 2),
+            'peak_kb': round(peak / 1024, 1),
+        }
+        print(f"{name:<36}{size:>9}{len(cars):>9}{best * 1000:>12.1f}{median * 1000:>13.1f}{size / best:>10.0f}{peak / 1024:>10.0f}")
+
+        if name in FIXTURES:
+            path = expected_path(name)
+            cars = [car.to_dict() for car in cars]
+            if args.update_baseline:
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(cars, f, ensure_ascii=False, indent=1)
+                    f.write('\n')
+            elif os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    expected = json.load(f)
+                if expected != cars:
+                    mismatch = next(
+                        (i for i, (a, b) in enumerate(zip(expected, cars)) if a != b),
+                        min(len(expected), len(cars))
+                    )
+                    failures.append(f"{name}: результат разбора отличается от эталона начиная с карточки #{mismatch}")
+
+        known = baseline.get(name)
+        if known is None:
+            continue
+        if known['digest'] != results[name]['digest']:
+            failures.append(f"{name}: найдено {len(cars)} карточек вместо {known['found']} или изменились поля")
+        if best * 1000 > known['best_ms'] * args.tolerance:
+            failures.append(f"{name}: разбор {best * 1000:.1f} мс против {known['best_ms']} мс в baseline")
+        if peak / 1024 > known['peak_kb'] * args.tolerance:
+            failures.append(f"{name}: пиковая память {peak / 1024:.0f} КБ против {known['peak_kb']} КБ в baseline")
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump({'backend': parsers.PARSER_BACKEND, **results}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"\nBaseline записан в {BASELINE_PATH}")
+        return 0
+
+    if not baseline:
+        print("\nBaseline не найден, сравнение пропущено. Запустите с --update-baseline")
+    elif baseline.get('backend') != parsers.PARSER_BACKEND:
+        print(f"\nВнимание: baseline снят с бэкендом {baseline.get('backend')}")
+
+    for name, expected in YEAR_CASES.items():
+        year = parsers.parse_year(name)
+        if year != expected:
+            failures.append(f"год из названия «{name}»: {year} вместо {expected}")
+
+    if failures:
+        print("\nРЕГРЕССИЯ:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+
+    print("\nРегрессий не найдено")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Бенчмарк времени запуска с бюджетами.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --app-budget 1.0
+
+Каждый замер идет в отдельном процессе с холодным импортом: импорт ядра
+парсинга (parsers), импорт main.py и сборка приложения create_app() без
+запуска фоновых потоков на пустых файлах состояния во временном каталоге.
+Медиана каждого замера сравнивается с бюджетом, а импорт parsers и main.py
+проверяется на загрузку тяжелых библиотек; при нарушении скрипт завершается
+с кодом 1. Сеть не используется.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Код замера: печатает JSON с длительностями в секундах
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import parsers
+parsers_import = time.perf_counter() - started
+heavy = [name for name in ('bs4', 'requests', 'lxml') if name in sys.modules]
+started = time.perf_counter()
+import main
+main_import = time.perf_counter() - started
+main_heavy = [name for name in ('telebot', 'requests', 'bs4', 'lxml', 'flask') if name in sys.modules]
+started = time.perf_counter()
+main.create_app(start=False)
+create_app = time.perf_counter() - started
+print(json.dumps({
+    'parsers': parsers_import, 'main': main_import, 'create_app': create_app,
+    'heavy': heavy, 'main_heavy': main_heavy,
+}))
+"""
+
+
+def probe(workdir):
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        BOT_TOKEN='1:benchmark',
+        WEBHOOK_URL='http://127.0.0.1/',
+        SNAPSHOT_STORE_PATH=os.path.join(workdir, 'catalog.sqlite3'),
+        PHOTO_CACHE_PATH=os.path.join(workdir, 'photo_cache.sqlite3'),
+        SUBSCRIPTIONS_PATH=os.path.join(workdir, 'subscriptions.sqlite3'),
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='число запусков')
+    parser.add_argument('--parsers-budget', type=float, default=0.05, help='бюджет импорта parsers, с')
+    parser.add_argument('--main-budget', type=float, default=0.5, help='бюджет импорта main.py, с')
+    parser.add_argument('--app-budget', type=float, default=1.5, help='бюджет create_app(), с')
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix='car-bot-startup-') as workdir:
+            runs.append(probe(workdir))
+
+    budgets = (
+        ('parsers', "импорт parsers", args.parsers_budget),
+        ('main', "импорт main.py", args.main_budget),
+        ('create_app', "create_app()", args.app_budget),
+    )
+
+    print(f"Запусков: {args.repeat}")
+    print(f"{'этап':<20}{'медиана, мс':>13}{'макс., мс':>11}{'бюджет, мс':>12}")
+    failures = []
+    for key, title, budget in budgets:
+        values = [run[key] for run in runs]
+        median = statistics.median(values)
+        print(f"{title:<20}{median * 1000:>13.1f}{max(values) * 1000:>11.1f}{budget * 1000:>12.0f}")
+        if median > budget:
+            failures.append(f"{title}: {median * 1000:.0f} мс при бюджете {budget * 1000:.0f} мс")
+
+    heavy = sorted({name for run in runs for name in run['heavy']})
+    if heavy:
+        failures.append(f"импорт parsers загружает {', '.join(heavy)}")
+    main_heavy = sorted({name for run in runs for name in run['main_heavy']})
+    if main_heavy:
+        failures.append(f"импорт main.py загружает {', '.join(main_heavy)}")
+
+    if failures:
+        print("\nБЮДЖЕТ ПРЕВЫШЕН:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+
+    print("\nВсе этапы уложились в бюджет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,407 @@
+"""Нагрузочный тест бота целиком на локальных заглушках.
+
+Запуск из корня репозитория:
+
+    python benchmarks/load_test.py --users 200 --rate-429 0.02
+
+Поднимает локальную заглушку Telegram Bot API (sendMessage, sendPhoto,
+sendMediaGroup, editMessageText и др., с заданной задержкой и случайными
+ответами 429) и заглушку сайтов дилеров, отдающую страницы из
+benchmarks/fixtures. Затем собирает приложение main.create_app() в режиме вебхука и
+проигрывает сессии пользователей через /webhook: /start, выбор категории,
+выбор марки по кнопке из полученной клавиатуры.
+
+Отчет: p50/p99 времени до первого ответа для каждого шага, p50/p99 времени
+до последней карточки первой порции марки и общая пропускная способность.
+Сеть не используется.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+BOT_TOKEN = '123456:LOADTEST'
+
+# Методы, которыми бот отправляет карточки автомобилей
+CARD_METHODS = {'sendPhoto', 'sendMediaGroup', 'sendMessage'}
+
+BRAND_BUTTON_RE = re.compile(r'\(\d+\)$')
+
+# Минимальный валидный JPEG для фото автомобилей
+TINY_JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f'
+    '141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100'
+    'ffc4001f0000010501010101010100000000000000000102030405060708090a0bffda0008010100003f00d2cf20ffd9'
+)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+class FakeTelegram:
+    """Заглушка Telegram Bot API: запоминает все вызовы и отвечает как настоящий API"""
+
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = []
+        self.injected_429 = 0
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def _message(self, chat_id, params, photo=False):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text') or params.get('caption') or '',
+        }
+        if photo:
+            n = next(self._file_ids)
+            message['photo'] = [{'file_id': f'file{n}', 'file_unique_id': f'u{n}', 'width': 1, 'height': 1}]
+        return message
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id not in (None, '') else None
+
+        if method not in ('getMe', 'setWebhook', 'deleteWebhook') and random.random() < self.rate_429:
+            with self._cond:
+                self.injected_429 += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(chat_id, params)
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, params, photo=True)
+        elif method == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            result = [self._message(chat_id, item, photo=True) for item in media]
+        else:
+            result = True
+
+        with self._cond:
+            self.calls.append((time.monotonic(), chat_id, method, params, result))
+            self._cond.notify_all()
+        return 200, {'ok': True, 'result': result}
+
+    def wait_for(self, chat_id, since, predicate=None, timeout=30):
+        """Первый вызов для чата после since, удовлетворяющий predicate"""
+        deadline = time.monotonic() + timeout
+        start = 0
+        with self._cond:
+            while True:
+                for i in range(start, len(self.calls)):
+                    call = self.calls[i]
+                    if call[1] == chat_id and call[0] >= since and (predicate is None or predicate(call)):
+                        return call
+                start = len(self.calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def last_call(self, chat_id, since, methods):
+        with self._cond:
+            times = [call[0] for call in self.calls if call[1] == chat_id and call[0] >= since and call[2] in methods]
+        return max(times) if times else None
+
+    def idle_for(self, seconds):
+        with self._cond:
+            last = self.calls[-1][0] if self.calls else 0
+        return time.monotonic() - last >= seconds
+
+
+def make_api_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            parts = urlsplit(self.path)
+            method = parts.path.rsplit('/', 1)[-1]
+            params = dict(parse_qsl(parts.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                body = self.rfile.read(length)
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode('utf-8')))
+
+            status, payload = fake.handle(method, params)
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class DealerHandler(BaseHTTPRequestHandler):
+    """Заглушка сайтов дилеров: страницы каталога из фикстур и фото"""
+
+    pages = {}
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path in self.pages:
+            body = self.pages[path]
+            content_type = 'text/html; charset=utf-8'
+        elif path.startswith('/upload/'):
+            body = TINY_JPEG
+            content_type = 'image/jpeg'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class Simulator:
+    """Проигрывает сессии пользователей через /webhook приложения"""
+
+    def __init__(self, main, fake, timeout):
+        self.main = main
+        self.client = main.app.test_client()
+        self.fake = fake
+        self.timeout = timeout
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.results = {'start': [], 'category': [], 'brand': []}
+        self.clicks = []
+        self.updates = 0
+        self.errors = 0
+
+    def _post(self, update):
+        update['update_id'] = next(self._update_ids)
+        response = self.client.post(
+            self.main.WEBHOOK_PATH, data=json.dumps(update), content_type='application/json',
+            headers={'X-Telegram-Bot-Api-Secret-Token': self.main.WEBHOOK_SECRET}
+        )
+        with self._lock:
+            self.updates += 1
+            if response.status_code != 200:
+                self.errors += 1
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+
+    def send_text(self, chat_id, text):
+        self._post({'message': {
+            'message_id': next(self._update_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self._user(chat_id),
+            'text': text,
+        }})
+
+    def click(self, chat_id, message_id, data):
+        self._post({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': '',
+            },
+        }})
+
+    def _record(self, step, started, call):
+        with self._lock:
+            if call is None:
+                self.errors += 1
+            else:
+                self.results[step].append(call[0] - started)
+
+    def session(self, chat_id, think_time):
+        started = time.monotonic()
+        self.send_text(chat_id, '/start')
+        self._record('start', started, self.fake.wait_for(chat_id, started, timeout=self.timeout))
+        time.sleep(random.uniform(0, think_time))
+
+        category = random.choice(["🔍 Все автомобили", "🚘 Новые", "🚗 Ретро"])
+        started = time.monotonic()
+        self.send_text(chat_id, category)
+
+        def has_brands(call):
+            return 'inline_keyboard' in (call[3].get('reply_markup') or '')
+
+        call = self.fake.wait_for(chat_id, started, has_brands, timeout=self.timeout)
+        self._record('category', started, call)
+        if call is None:
+            return
+        time.sleep(random.uniform(0, think_time))
+
+        markup = json.loads(call[3]['reply_markup'])
+        buttons = [
+            button for row in markup['inline_keyboard'] for button in row
+            if BRAND_BUTTON_RE.search(button.get('text', '')) and button.get('callback_data')
+        ]
+        if not buttons:
+            return
+        message_id = call[4]['message_id']
+
+        started = time.monotonic()
+        self.click(chat_id, message_id, random.choice(buttons)['callback_data'])
+        self._record('brand', started, self.fake.wait_for(chat_id, started, timeout=self.timeout))
+        with self._lock:
+            self.clicks.append((chat_id, started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='число пользователей')
+    parser.add_argument('--concurrency', type=int, default=100, help='сколько пользователей действуют одновременно')
+    parser.add_argument('--think-time', type=float, default=1.0, help='максимальная пауза пользователя между шагами, с')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='задержка ответа заглушки Telegram, с')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля вызовов, на которые заглушка отвечает 429')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать ответа бота, с')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    fake = FakeTelegram(latency=args.api_latency, rate_429=args.rate_429)
+    api_server = serve(make_api_handler(fake))
+
+    DealerHandler.pages = {}
+    for source in ('antiqcar', 'antarmotors'):
+        with open(os.path.join(FIXTURES_DIR, f'{source}_market.html'), 'rb') as f:
+            DealerHandler.pages[f'/{source}/market'] = f.read()
+    dealer_server = serve(DealerHandler)
+    dealer_url = f'http://127.0.0.1:{dealer_server.server_port}'
+
+    # Бот запускается в режиме вебхука, все файлы состояния - во временном каталоге
+    workdir = tempfile.mkdtemp(prefix='car-bot-load-')
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'WEBHOOK_URL': 'http://127.0.0.1/',
+        'SNAPSHOT_STORE_PATH': os.path.join(workdir, 'catalog.sqlite3'),
+        'PHOTO_CACHE_PATH': os.path.join(workdir, 'photo_cache.sqlite3'),
+        'SUBSCRIPTIONS_PATH': os.path.join(workdir, 'subscriptions.sqlite3'),
+    })
+
+    import telebot.apihelper
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{api_server.server_port}/bot{{0}}/{{1}}'
+
+    import parsers
+    parsers.ANTIQCAR.url = f'{dealer_url}/antiqcar/market'
+    parsers.ANTARMOTORS.url = f'{dealer_url}/antarmotors/market'
+
+    import logging
+    logging.disable(logging.WARNING)
+
+    started = time.monotonic()
+    import main as bot_main
+    bot_main.create_app()
+    while not bot_main.catalog.ready and time.monotonic() - started < args.timeout:
+        time.sleep(0.05)
+    print(f"Каталог готов за {time.monotonic() - started:.2f} с: {len(bot_main.catalog.snapshot().cars)} автомобилей")
+
+    simulator = Simulator(bot_main, fake, args.timeout)
+    semaphore = threading.Semaphore(args.concurrency)
+
+    def run_user(chat_id):
+        with semaphore:
+            try:
+                simulator.session(chat_id, args.think_time)
+            except Exception as e:
+                print(f"Ошибка сессии {chat_id}: {e}")
+
+    calls_before = len(fake.calls)
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_user, args=(100000 + i,)) for i in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Ждем, пока бот доотправит карточки
+    deadline = time.monotonic() + args.timeout
+    while not fake.idle_for(2.0) and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+    last_card = []
+    for chat_id, clicked in simulator.clicks:
+        last = fake.last_call(chat_id, clicked, CARD_METHODS)
+        if last is not None:
+            last_card.append(last - clicked)
+    wall = fake.calls[-1][0] - started
+    api_calls = len(fake.calls) - calls_before
+
+    print(f"\nПользователей: {args.users}, обновлений: {simulator.updates}, ошибок: {simulator.errors}")
+    print(f"{'шаг':<28}{'n':>6}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    rows = [
+        ('первый ответ: /start', simulator.results['start']),
+        ('первый ответ: категория', simulator.results['category']),
+        ('первый ответ: марка', simulator.results['brand']),
+        ('последняя карточка порции', last_card),
+    ]
+    for title, values in rows:
+        print(f"{title:<28}{len(values):>6}{percentile(values, 50) * 1000:>10.0f}"
+              f"{percentile(values, 99) * 1000:>10.0f}{(max(values) if values else float('nan')) * 1000:>10.0f}")
+
+    print(f"\nВремя теста: {wall:.1f} с")
+    print(f"Пропускная способность: {simulator.updates / wall:.1f} обновлений/с, {api_calls / wall:.1f} вызовов API/с")
+    print(f"Ответов 429 от заглушки: {fake.injected_429}, повторов в очереди отправки: {bot_main.send_queue.rate_limited}")
+
+    api_server.shutdown()
+    dealer_server.shutdown()
+    return 0 if simulator.errors == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Предохранитель источника.
+
+    После failure_threshold неудач подряд размыкается, и источник не опрашивается
+    до retry_at. Пауза растет экспоненциально от base_delay до max_delay
+    со случайным разбросом, чтобы повторы не совпадали. По истечении паузы
+    пропускает одну пробную попытку: успех замыкает предохранитель, неудача
+    снова размыкает его на удвоенный срок.
+    """
+
+    def __init__(self, name, failure_threshold=3, base_delay=60, max_delay=3600, history=20):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = None
+        self.last_error = None
+        self.events = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def _event(self, event, **details):
+        self.events.append({'time': time.time(), 'event': event, **details})
+
+    def allow(self):
+        """Можно ли сейчас опрашивать источник"""
+        with self._lock:
+            if self.state == OPEN and time.time() >= self.retry_at:
+                self.state = HALF_OPEN
+                self._event('half_open')
+            return self.state != OPEN
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"Источник {self.name} снова доступен")
+                self._event('recovered', failures=self.failures)
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = 0
+            self.retry_at = None
+            self.last_error = None
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** (self.opened - 1))
+                # Случайная пауза из второй половины интервала
+                delay = random.uniform(delay / 2, delay)
+                self.state = OPEN
+                self.retry_at = time.time() + delay
+                logger.warning(f"Источник {self.name} отключен на {delay:.0f} с после {self.failures} неудач: {error}")
+                self._event('opened', delay=round(delay), error=self.last_error)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_at': self.retry_at,
+                'last_error': self.last_error,
+                'events': list(self.events),
+            }
@@ -0,0 +1,59 @@
+"""Компактные данные inline-кнопок.
+
+Telegram ограничивает callback_data 64 байтами, поэтому вместо названия марки
+в кнопку кладется упакованная структура: действие, категория, версия снимка,
+номер марки в снимке и страница. В base64 она занимает 14 символов.
+"""
+import base64
+import binascii
+import struct
+import zlib
+from collections import namedtuple
+
+from catalog import CATEGORIES
+
+BRAND = 1
+PAGE = 2
+SUBSCRIBE_BRAND = 3
+# Следующая порция карточек марки; version - версия содержимого снимка, page - номер первой карточки порции
+MORE = 4
+# Меню фильтров категории и выборка по фильтру; brand_id - номер фильтра, page - номер первой карточки
+FILTER_MENU = 5
+FILTER = 6
+# Подписка на новинки категории и отписка от нее; категория None - все автомобили
+SUBSCRIBE_CATEGORY = 7
+UNSUBSCRIBE_CATEGORY = 8
+# Отписка от марки; version - key_checksum ключа марки, которой может уже не быть в снимке
+UNSUBSCRIBE_BRAND = 9
+
+ACTIONS = (BRAND, PAGE, SUBSCRIBE_BRAND, MORE, FILTER_MENU, FILTER, SUBSCRIBE_CATEGORY, UNSUBSCRIBE_CATEGORY, UNSUBSCRIBE_BRAND)
+
+# action, category, version, brand_id, page
+_FORMAT = struct.Struct('>BBIHH')
+TOKEN_LENGTH = len(base64.urlsafe_b64encode(b'\0' * _FORMAT.size).rstrip(b'='))
+
+Callback = namedtuple('Callback', 'action category version brand_id page')
+
+
+def encode(action, category=None, version=0, brand_id=0, page=0):
+    data = _FORMAT.pack(action, CATEGORIES.index(category), version, brand_id, page)
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def key_checksum(key):
+    """Короткая контрольная сумма ключа для кнопки, когда номер в снимке не подходит"""
+    return zlib.crc32(key.encode('utf-8'))
+
+
+def decode(data):
+    """Разбирает данные кнопки; для данных другого формата возвращает None"""
+    if len(data) != TOKEN_LENGTH:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        action, category, version, brand_id, page = _FORMAT.unpack(raw)
+    except (binascii.Error, ValueError, struct.error):
+        return None
+    if action not in ACTIONS or category >= len(CATEGORIES):
+        return None
+    return Callback(action, CATEGORIES[category], version, brand_id, page)
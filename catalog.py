@@ -0,0 +1,403 @@
+import bisect
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+import zlib
+
+import metrics
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+BRANDS_PER_PAGE = 15
+
+INDEX_LOOKUPS = metrics.counter('car_bot_index_lookups_total', 'Поиск марки в индексе снимка', ('result',))
+
+# Категории, для которых строится индекс; None - все автомобили
+CATEGORIES = (None, 'retro', 'new', 'children')
+
+# Диапазоны цен сравниваются только в этой валюте
+PRICE_CURRENCY = 'RUB'
+
+
+def brand_key(brand):
+    """Ключ группировки автомобилей по марке"""
+    return brand.lower().strip()
+
+
+# Поля объявления; stale - объявление взято из прошлого парсинга недоступного сайта
+LISTING_FIELDS = (
+    'name', 'brand', 'price', 'photo', 'link', 'location', 'year',
+    'year_value', 'price_value', 'currency', 'source', 'category', 'stale',
+)
+
+# Поля с небольшим набором повторяющихся значений: хранятся в единственном экземпляре
+INTERNED_FIELDS = ('brand', 'price', 'location', 'year', 'currency', 'source', 'category')
+
+
+class Listing:
+    """Объявление автомобиля.
+
+    Компактная запись со __slots__ вместо словаря на каждое объявление;
+    повторяющиеся строки интернируются. Читается как словарь: car['name'], car.get('photo').
+    """
+    __slots__ = LISTING_FIELDS
+
+    def __init__(self, **fields):
+        for field in LISTING_FIELDS:
+            value = fields.pop(field, None)
+            if field in INTERNED_FIELDS and value is not None:
+                value = sys.intern(str(value))
+            setattr(self, field, value)
+        if fields:
+            raise TypeError(f"Неизвестные поля объявления: {', '.join(fields)}")
+        self.stale = bool(self.stale)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        """Словарь для JSON; stale сохраняется, только если установлен"""
+        data = {field: getattr(self, field) for field in LISTING_FIELDS}
+        if not self.stale:
+            del data['stale']
+        return data
+
+    def replace(self, **changes):
+        """Копия объявления с измененными полями"""
+        return Listing(**{**self.to_dict(), **changes})
+
+    def __getitem__(self, field):
+        if field not in LISTING_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in LISTING_FIELDS else default
+
+    def __repr__(self):
+        return f"Listing({self.to_dict()!r})"
+
+
+def dump_listings(cars, **kwargs):
+    """JSON списка объявлений"""
+    return json.dumps(cars, ensure_ascii=False, default=Listing.to_dict, **kwargs)
+
+
+def load_listings(data):
+    return [Listing.from_dict(car) for car in json.loads(data)]
+
+
+class BrandEntry:
+    """Марка внутри категории со списком ее автомобилей"""
+
+    def __init__(self, key, display_name):
+        self.key = key
+        self.display_name = display_name
+        self.cars = []
+
+    @property
+    def count(self):
+        return len(self.cars)
+
+
+def _sorted_by(cars, field, currency=None):
+    """Автомобили с известным значением field по возрастанию и список самих значений"""
+    selected = sorted(
+        (car for car in cars if car.get(field) is not None and (currency is None or car.get('currency') == currency)),
+        key=lambda car: car[field]
+    )
+    return selected, [car[field] for car in selected]
+
+
+def _range(cars, keys, low=None, high=None):
+    """Срез cars со значениями в полуинтервале [low, high)"""
+    start = bisect.bisect_left(keys, low) if low is not None else 0
+    end = bisect.bisect_left(keys, high) if high is not None else len(keys)
+    return cars[start:end]
+
+
+class CategoryIndex:
+    """Отсортированные марки категории и готовые страницы по BRANDS_PER_PAGE марок.
+
+    Для фильтров держит автомобили, отсортированные по цене и по году:
+    диапазоны отвечаются бинарным поиском.
+    """
+
+    def __init__(self, cars, per_page=BRANDS_PER_PAGE):
+        self.cars = cars
+        self.per_page = per_page
+
+        # Группируем по брендам, сохраняя оригинальное написание первой встреченной марки
+        by_key = {}
+        for car in cars:
+            key = brand_key(car['brand'])
+            entry = by_key.get(key)
+            if entry is None:
+                entry = by_key[key] = BrandEntry(key, car['brand'])
+            entry.cars.append(car)
+
+        self.by_key = by_key
+        self.brands = sorted(by_key.values(), key=lambda entry: entry.display_name)
+        self.pages = [self.brands[i:i + per_page] for i in range(0, len(self.brands), per_page)] or [[]]
+
+        self.by_price, self.price_keys = _sorted_by(cars, 'price_value', PRICE_CURRENCY)
+        self.by_year, self.year_keys = _sorted_by(cars, 'year_value')
+
+        # Все автомобили от дешевых к дорогим; без цены - в конце
+        priced = set(map(id, self.by_price))
+        self.by_price_all = self.by_price + [car for car in cars if id(car) not in priced]
+
+    @property
+    def total_pages(self):
+        return len(self.pages)
+
+    def page(self, number):
+        """Марки на странице number (нумерация с 1)"""
+        if 1 <= number <= len(self.pages):
+            return self.pages[number - 1]
+        return []
+
+    def brand(self, key):
+        entry = self.by_key.get(key)
+        INDEX_LOOKUPS.inc(result='hit' if entry is not None else 'miss')
+        return entry
+
+    def price_range(self, low=None, high=None):
+        """Автомобили с ценой от low включительно до high, от дешевых к дорогим"""
+        return _range(self.by_price, self.price_keys, low, high)
+
+    def year_range(self, low=None, high=None):
+        """Автомобили с годом выпуска от low включительно до high, от старых к новым"""
+        return _range(self.by_year, self.year_keys, low, high)
+
+    def cheapest(self):
+        """Все автомобили от дешевых к дорогим; без цены - в конце"""
+        return self.by_price_all
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога автомобилей на момент парсинга.
+
+    Индексы по категориям и маркам строятся один раз при создании снимка.
+    """
+
+    def __init__(self, cars, created_at=None):
+        self.cars = cars
+        self.created_at = created_at if created_at is not None else time.time()
+
+        # Хеш содержимого: готовые тексты сообщений действительны, пока он не изменился
+        data = dump_listings(cars, sort_keys=True).encode('utf-8')
+        self.content_hash = hashlib.sha1(data).hexdigest()
+        # Версия содержимого для кнопок продолжения выборки: смещение в списке верно, пока он не изменился
+        self.content_version = int(self.content_hash[:8], 16)
+
+        by_category = {category: [] for category in CATEGORIES if category}
+        for car in cars:
+            by_category.setdefault(car.get('category'), []).append(car)
+
+        self.categories = {None: CategoryIndex(cars)}
+        for category, category_cars in by_category.items():
+            self.categories[category] = CategoryIndex(category_cars)
+
+        # Короткие номера марок для кнопок: позиция в общем отсортированном списке.
+        # Версия зависит только от набора марок, поэтому кнопки старых сообщений
+        # остаются рабочими, пока марки не изменились
+        brands = self.categories[None].brands
+        self.brand_ids = {entry.key: i for i, entry in enumerate(brands)}
+        self.version = zlib.crc32('\n'.join(entry.key for entry in brands).encode('utf-8'))
+
+        # Поиск для inline-режима
+        self.search = SearchIndex(cars)
+
+    @property
+    def age(self):
+        """Возраст снимка в секундах"""
+        return time.time() - self.created_at
+
+    def category(self, category=None):
+        """Индекс категории; для неизвестной категории - пустой индекс"""
+        index = self.categories.get(category or None)
+        if index is None:
+            index = CategoryIndex([])
+        return index
+
+    def brand_key_by_id(self, brand_id):
+        """Ключ марки по ее номеру в снимке или None"""
+        brands = self.categories[None].brands
+        if 0 <= brand_id < len(brands):
+            return brands[brand_id].key
+        return None
+
+
+def listing_key(car):
+    """Стабильный ключ объявления между парсингами"""
+    return car.get('link') or f"{car.get('source')}:{car.get('name')}"
+
+
+class CatalogDiff:
+    """Изменения между двумя снимками: новые, снятые и подорожавшие/подешевевшие объявления.
+
+    price_changed содержит пары (старое объявление, новое объявление).
+    """
+
+    def __init__(self, added, removed, price_changed):
+        self.added = added
+        self.removed = removed
+        self.price_changed = price_changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.price_changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.price_changed)
+
+
+def diff_snapshots(old, new):
+    """Сравнивает снимки по ключу объявления"""
+    old_cars = {listing_key(car): car for car in old.cars} if old is not None else {}
+    new_cars = {listing_key(car): car for car in new.cars}
+
+    added = [car for key, car in new_cars.items() if key not in old_cars]
+    removed = [car for key, car in old_cars.items() if key not in new_cars]
+    price_changed = [
+        (old_cars[key], car) for key, car in new_cars.items()
+        if key in old_cars and old_cars[key]['price'] != car['price']
+    ]
+    return CatalogDiff(added, removed, price_changed)
+
+
+class Catalog:
+    """Хранит текущий снимок каталога и обновляет его в фоновом потоке.
+
+    Обработчики читают снимок без блокировок и без обращения к сети.
+    Пока идет обновление, отдается предыдущий снимок (stale-while-revalidate).
+
+    Если задан leader (FileLock), сайты опрашивает только процесс, владеющий
+    блокировкой. Остальные раз в follow_interval секунд берут опубликованный им
+    снимок через follow(version) -> (версия, снимок или None) и пытаются стать
+    лидером, если прежний завершился.
+    """
+
+    def __init__(self, loader, refresh_interval=300, leader=None, follow=None, follow_interval=5):
+        self._loader = loader
+        self.refresh_interval = refresh_interval
+        self.leader = leader
+        self._follow = follow
+        self.follow_interval = follow_interval
+        self._followed_version = 0
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self._listeners = []
+        self.last_error = None
+
+    @property
+    def is_leader(self):
+        return self.leader is None or self.leader.held
+
+    def add_listener(self, listener, followed=False):
+        """Подписывает listener(snapshot) на каждое успешное обновление каталога.
+
+        followed=True - на снимки, полученные от лидера, а не загруженные этим процессом.
+        """
+        self._listeners.append((listener, followed))
+
+    def _notify(self, snapshot, followed=False):
+        for listener, for_followed in self._listeners:
+            if for_followed != followed:
+                continue
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика обновления каталога: {e}")
+
+    def snapshot(self):
+        """Текущий снимок или None, если первый парсинг еще не завершен"""
+        return self._snapshot
+
+    @property
+    def ready(self):
+        return self._snapshot is not None
+
+    @property
+    def age(self):
+        snapshot = self._snapshot
+        return snapshot.age if snapshot else None
+
+    def restore(self, snapshot):
+        """Отдает сохраненный снимок, пока не завершится первый парсинг"""
+        if self._snapshot is None and snapshot is not None:
+            self._snapshot = snapshot
+            logger.info(f"Восстановлен сохраненный каталог: {len(snapshot.cars)} автомобилей, возраст {snapshot.age:.0f} с")
+
+    def refresh(self):
+        """Синхронно загружает новый снимок и подменяет текущий"""
+        # Не запускаем параллельные обновления
+        if not self._refresh_lock.acquire(blocking=False):
+            return self._snapshot
+
+        try:
+            started = time.time()
+            cars = self._loader()
+
+            # Пустой результат обычно означает, что сайты недоступны -
+            # в этом случае продолжаем отдавать старые данные
+            if not cars and self._snapshot is not None:
+                logger.warning("Парсинг вернул пустой список, оставляем предыдущий снимок")
+                return self._snapshot
+
+            self._snapshot = CatalogSnapshot(cars, created_at=started)
+            self.last_error = None
+            logger.info(f"Каталог обновлен: {len(cars)} автомобилей за {time.time() - started:.1f} с")
+            self._notify(self._snapshot)
+            return self._snapshot
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"Ошибка обновления каталога: {e}")
+            return self._snapshot
+        finally:
+            self._refresh_lock.release()
+
+    def follow(self):
+        """Подхватывает снимок, опубликованный лидером, если он новее текущего"""
+        try:
+            version, snapshot = self._follow(self._followed_version)
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"Ошибка чтения опубликованного каталога: {e}")
+            return self._snapshot
+
+        self._followed_version = version
+        if snapshot is not None:
+            self._snapshot = snapshot
+            self.last_error = None
+            logger.info(f"Получен каталог лидера, версия {version}: {len(snapshot.cars)} автомобилей")
+            self._notify(snapshot, followed=True)
+        return self._snapshot
+
+    def _run(self):
+        while True:
+            was_leader = self.is_leader
+            if self.leader is None or self.leader.acquire():
+                # Новый лидер продолжает с последнего опубликованного снимка
+                if not was_leader and self._follow is not None:
+                    self.follow()
+                self.refresh()
+                interval = self.refresh_interval
+            else:
+                self.follow()
+                interval = self.follow_interval
+            time.sleep(interval)
+
+    def start(self):
+        """Запускает фоновое обновление каталога"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='catalog-refresh')
+        self._thread.daemon = True
+        self._thread.start()
@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from ratelimit import TokenBucket
+
+
+class CrawlResult:
+    """Итог обхода одного источника: объявления страниц в порядке обнаружения или ошибка.
+
+    error - ошибка стартовой страницы, она проваливает весь источник. Ошибки
+    страниц, найденных по ссылкам, собираются в page_errors: url -> исключение.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.pages = {}
+        self.order = []
+        self.pending = 0
+        self.error = None
+        self.page_errors = {}
+        self.timed_out = False
+        self.elapsed = None
+
+    @property
+    def done(self):
+        return self.pending == 0
+
+    @property
+    def ok(self):
+        return self.done and self.error is None and not self.timed_out
+
+    def cars(self):
+        result = []
+        for url in self.order:
+            result.extend(self.pages.get(url, ()))
+        return result
+
+
+class _Host:
+    def __init__(self, concurrency, bucket):
+        self.concurrency = concurrency
+        self.bucket = bucket
+        self.queue = deque()
+        self.in_flight = 0
+
+
+class Crawler:
+    """Планировщик обхода страниц источников.
+
+    Страницы всех хостов загружаются параллельно, но к одному хосту идет не больше
+    concurrency_per_host запросов одновременно и не больше rate_per_host в секунду.
+    Поэтому время обхода определяется самым большим сайтом, а не суммой страниц.
+    limits переопределяет ограничения для отдельных хостов: host -> (concurrency, rate).
+    """
+
+    def __init__(self, concurrency_per_host=2, rate_per_host=2.0, workers=16, limits=None):
+        self.concurrency_per_host = concurrency_per_host
+        self.rate_per_host = rate_per_host
+        self.limits = dict(limits or {})
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crawl')
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, host):
+        return self.limits.get(host, (self.concurrency_per_host, self.rate_per_host))
+
+    def _bucket(self, host):
+        # Ведро токенов хоста общее для всех обходов, чтобы лимит соблюдался и между ними
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate = self._limits(host)[1]
+                bucket = self._buckets[host] = TokenBucket(rate, max(1.0, rate))
+            return bucket
+
+    @contextmanager
+    def slot(self, url):
+        """Место в лимитах хоста для запроса вне обхода, например проверки фото.
+
+        Токен берется из того же ведра, что и при обходе, поэтому вместе они не превышают
+        rate_per_host. Таких запросов к хосту одновременно не больше его concurrency.
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._slots.get(host)
+            if semaphore is None:
+                semaphore = self._slots[host] = threading.BoundedSemaphore(self._limits(host)[0])
+        with semaphore:
+            self._bucket(host).consume()
+            yield
+
+    def crawl(self, sources, fetch, deadline=None):
+        """Обходит источники и возвращает {имя источника: CrawlResult}.
+
+        fetch(spec, url) возвращает (объявления страницы, ссылки на другие страницы).
+        Источник, не уложившийся в свой срок (deadline или spec.deadline),
+        помечается timed_out; его оставшиеся страницы не загружаются.
+        """
+        started = time.monotonic()
+        cond = threading.Condition()
+        results = {spec.name: CrawlResult(spec) for spec in sources}
+        seen = {spec.name: set() for spec in sources}
+        hosts = {}
+
+        def schedule(spec, url):
+            result = results[spec.name]
+            if url in seen[spec.name] or result.error is not None or result.timed_out:
+                return
+            seen[spec.name].add(url)
+            result.order.append(url)
+            result.pending += 1
+            name = urlsplit(url).netloc
+            host = hosts.get(name)
+            if host is None:
+                host = hosts[name] = _Host(self._limits(name)[0], self._bucket(name))
+            host.queue.append((spec, url))
+            pump(host)
+
+        def pump(host):
+            # Новые задачи хоста отправляются в пул, только когда есть свободный слот
+            while host.in_flight < host.concurrency and host.queue:
+                spec, url = host.queue.popleft()
+                result = results[spec.name]
+                if result.error is not None or result.timed_out:
+                    result.pending -= 1
+                    continue
+                host.in_flight += 1
+                self._executor.submit(run, host, spec, url)
+
+        def run(host, spec, url):
+            error = None
+            cars, links = (), ()
+            try:
+                host.bucket.consume()
+                cars, links = fetch(spec, url)
+            except Exception as e:
+                error = e
+
+            with cond:
+                host.in_flight -= 1
+                result = results[spec.name]
+                result.pending -= 1
+                if result.pending == 0:
+                    result.elapsed = time.monotonic() - started
+                if error is not None:
+                    if url not in spec.start_urls:
+                        # Страница из пагинации могла исчезнуть - теряем только ее
+                        result.page_errors[url] = error
+                    elif result.error is None:
+                        result.error = error
+                elif not result.timed_out:
+                    result.pages[url] = cars
+                    for link in links:
+                        schedule(spec, link)
+                pump(host)
+                cond.notify_all()
+
+        with cond:
+            for spec in sources:
+                for url in spec.start_urls:
+                    schedule(spec, url)
+
+            def source_deadline(spec):
+                return started + (deadline if deadline is not None else spec.deadline)
+
+            while True:
+                now = time.monotonic()
+                # Источник с ошибкой уже провален, его оставшиеся страницы не ждем
+                waiting = [r for r in results.values() if not r.done and not r.timed_out and r.error is None]
+                for result in waiting:
+                    if now >= source_deadline(result.spec):
+                        result.timed_out = True
+                waiting = [r for r in waiting if not r.timed_out]
+                if not waiting:
+                    break
+                cond.wait(min(source_deadline(r.spec) for r in waiting) - now)
+
+            # Оставшиеся в очередях страницы больше не нужны
+            for host in hosts.values():
+                host.queue.clear()
+
+        return results
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление, или None"""
+    for message in (update.message, update.edited_message, update.channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message is not None else call.from_user.id
+    if update.inline_query is not None:
+        return update.inline_query.from_user.id
+    return None
+
+
+class ChatDispatcher:
+    """Диспетчер входящих обновлений Telegram.
+
+    Обновления одного чата обрабатываются строго по очереди, разные чаты -
+    параллельно в workers потоках. Долгий обработчик задерживает только свой чат.
+    Общее число ожидающих обновлений ограничено max_pending.
+    """
+
+    def __init__(self, handler, workers=8, max_pending=1000):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._chats = {}
+        self._ready = deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+        self.processed = 0
+        self.rejected = 0
+        self.busy_workers = 0
+
+    def submit(self, update, block=False, timeout=None):
+        """Ставит обновление в очередь его чата.
+
+        Если очередь заполнена, при block=False сразу возвращает False,
+        иначе ждет освобождения места не дольше timeout.
+        """
+        chat_id = update_chat_id(update)
+        # Обновления без чата не упорядочиваем между собой
+        key = chat_id if chat_id is not None else ('update', update.update_id)
+
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._pending >= self.max_pending:
+                if not block:
+                    self.rejected += 1
+                    logger.warning("Очередь обновлений переполнена, обновление отклонено")
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.rejected += 1
+                    return False
+                self._cond.wait(remaining)
+
+            jobs = self._chats.get(key)
+            if jobs is None:
+                # Чат не обрабатывается и не ждет - ставим его в очередь готовых
+                jobs = self._chats[key] = deque()
+                self._ready.append(key)
+            jobs.append(update)
+            self._pending += 1
+            self._cond.notify_all()
+        return True
+
+    def stats(self):
+        """Метрики очереди для мониторинга"""
+        with self._cond:
+            depths = [len(jobs) for jobs in self._chats.values()]
+            return {
+                'pending': self._pending,
+                'active_chats': len(self._chats),
+                'max_chat_depth': max(depths) if depths else 0,
+                'busy_workers': self.busy_workers,
+                'workers': self.workers,
+                'processed': self.processed,
+                'rejected': self.rejected,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                update = self._chats[key].popleft()
+                self.busy_workers += 1
+
+            try:
+                self.handler(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {e}")
+
+            with self._cond:
+                self.busy_workers -= 1
+                self.processed += 1
+                self._pending -= 1
+                if self._chats[key]:
+                    # Следующее обновление чата - в конец очереди, чтобы не задерживать другие чаты
+                    self._ready.append(key)
+                else:
+                    del self._chats[key]
+                self._cond.notify_all()
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'update-{i}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
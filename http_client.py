@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+
+class Page:
+    """Результат загрузки страницы.
+
+    Если сервер ответил 304, text равен None, а content_hash совпадает
+    с хешем последней полученной версии страницы.
+    """
+
+    def __init__(self, url, text, content_hash, not_modified=False):
+        self.url = url
+        self.text = text
+        self.content_hash = content_hash
+        self.not_modified = not_modified
+
+
+class HttpClient:
+    """Долгоживущий HTTP-клиент с пулом соединений на каждый хост.
+
+    Запоминает ETag/Last-Modified и хеш содержимого каждой страницы,
+    чтобы отправлять условные запросы и не разбирать неизменившиеся страницы.
+    """
+
+    def __init__(self, headers=None, timeout=15, pool_size=4):
+        self.headers = dict(DEFAULT_HEADERS if headers is None else headers)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._validators = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Сессия с пулом соединений для хоста из url"""
+        # requests загружается при первом запросе, а не при импорте парсеров
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                # Не используем переменные окружения для прокси
+                session.trust_env = False
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def validators(self, url):
+        """ETag, Last-Modified и хеш последней версии страницы"""
+        return self._validators.get(url)
+
+    def export_validators(self):
+        return {url: dict(known) for url, known in self._validators.items()}
+
+    def load_validators(self, validators):
+        """Восстанавливает валидаторы, например после перезапуска"""
+        self._validators.update(validators)
+
+    def fetch(self, url, timeout=None, conditional=True):
+        session = self.session(url)
+        known = self._validators.get(url) if conditional else None
+
+        headers = {}
+        if known:
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+
+        response = session.get(url, headers=headers, timeout=timeout or self.timeout)
+
+        if response.status_code == 304 and known:
+            return Page(url, None, known['hash'], not_modified=True)
+
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+
+        content_hash = hashlib.sha1(response.content).hexdigest()
+        self._validators[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': content_hash,
+        }
+        return Page(url, response.text, content_hash)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -0,0 +1,68 @@
+"""Выбор одного процесса-лидера среди нескольких копий бота на одном хосте.
+
+Лидером становится процесс, захвативший блокировку файла. Блокировка
+принадлежит открытому дескриптору, поэтому снимается операционной системой,
+когда лидер завершается, и ее может захватить следующий процесс.
+"""
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """Неблокирующая межпроцессная блокировка на файле"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self):
+        """Пытается захватить блокировку, не дожидаясь ее; True, если она у этого процесса"""
+        if self._file is not None:
+            return True
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lock_file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._file = lock_file
+        logger.info(f"Процесс {os.getpid()} захватил блокировку {self.path}")
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
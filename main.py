@@ -1,294 +1,319 @@
+"""Telegram-бот каталога автомобилей.
+
+Импорт модуля ничего не запускает: бот, хранилища, фоновые потоки и веб-приложение
+создаются в create_app(), а переменные окружения и .env читаются в main().
+Flask, waitress, dotenv, telebot и requests импортируются только при запуске
+и в обработчиках.
+"""
+import hashlib
+import hmac
 import logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-logger.info("Бот запущен и готов к работе...")
-
 import os
-os.environ['no_proxy'] = '*'
-os.environ['NO_PROXY'] = '*'
-
-# Импорт необходимых модулей
-import requests
-from bs4 import BeautifulSoup
-import telebot
-from telebot import types
-from urllib.parse import urljoin
-import re
-from collections import defaultdict
-import time
-from dotenv import load_dotenv
-from flask import Flask, jsonify
 import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache, partial
+
+import callbacks
+import metrics
+import profiling
+from catalog import Catalog, listing_key
+from crawler import Crawler
+from dispatcher import ChatDispatcher
+from leader import FileLock
+import parsers
+from parsers import http_client, parse_all_cars
+from photo_cache import PhotoCache, PhotoPrefetcher
+from render_cache import RenderCache
+from sender import Card, SendQueue, TelegramSender, telegram_request_sender
+from store import SnapshotStore
+from subscriptions import ALL_CATEGORIES, ChangeNotifier, SubscriptionStore
 
-# Загрузка переменных окружения
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Получение токена
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-if not BOT_TOKEN:
-    logger.error("ОШИБКА: BOT_TOKEN не найден. Проверьте Secrets!")
-    exit(1)
+WEBHOOK_PATH = '/webhook'
+
+# Настройки и объекты приложения; задаются в create_app()
+WEBHOOK_URL = None
+WEBHOOK_SECRET = None
+PORT = 8080
+CATALOG_MAX_AGE = 900
+POLLING_MAX_LAG = 120
+CARDS_CHUNK_SIZE = 10
+PROFILE_MAX_SECONDS = 60
+PROFILE_TOKEN = None
+
+bot = None
+app = None
+catalog = None
+snapshot_store = None
+send_queue = None
+photo_cache = None
+sender = None
+dispatcher = None
+subscriptions = None
+notifier = None
+render_cache = None
+
+# Время запуска сверх этого бюджета попадает в лог предупреждением
+STARTUP_BUDGET = 3.0
+
+STARTUP_DURATION = metrics.gauge('car_bot_startup_seconds', 'Длительность этапов запуска', ('phase',))
+
+@contextmanager
+def startup_phase(name, durations):
+    """Замер этапа запуска: длительность пишется в метрику и в durations"""
+    started = time.perf_counter()
+    yield
+    durations[name] = time.perf_counter() - started
+    STARTUP_DURATION.set(durations[name], phase=name)
+
+def create_app(start=True):
+    """Собирает приложение из переменных окружения и возвращает Flask-приложение.
+
+    Восстанавливает сохраненный каталог и, если start, запускает фоновые потоки:
+    обновление каталога, рассылку, очередь отправки и диспетчер обновлений.
+    Веб-сервер и прием обновлений запускает main().
+    """
+    global WEBHOOK_URL, WEBHOOK_SECRET, PORT, CATALOG_MAX_AGE, POLLING_MAX_LAG, CARDS_CHUNK_SIZE
+    global PROFILE_MAX_SECONDS, PROFILE_TOKEN
+    global bot, app, catalog, snapshot_store, send_queue, photo_cache, sender, dispatcher
+    global subscriptions, notifier, render_cache
+
+    started = time.perf_counter()
+    durations = {}
+
+    with startup_phase('bot', durations):
+        # PROFILING=1 включает интервалы этапов, лог запросов дольше SLOW_REQUEST_THRESHOLD
+        # и /debug/profile со сэмплирующим профилировщиком, доступный только с заголовком X-Profile-Token
+        profiling.configure(
+            os.getenv('PROFILING', '').lower() in ('1', 'true', 'yes'),
+            float(os.getenv('SLOW_REQUEST_THRESHOLD', '1.0')),
+        )
+        PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '60'))
+        PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+
+        token = os.getenv('BOT_TOKEN')
+        if not token:
+            raise RuntimeError("BOT_TOKEN не задан")
+
+        # Режим вебхука включается переменной WEBHOOK_URL, иначе бот работает через long polling
+        WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+        # Вебхук принимает обновления только с секретом, переданным Telegram в set_webhook;
+        # без WEBHOOK_SECRET секрет выводится из токена бота - он одинаков у всех копий бота
+        # и после перезапуска, а без токена его не подобрать
+        WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (
+            hmac.new(token.encode('utf-8'), b'webhook-secret', hashlib.sha256).hexdigest() if WEBHOOK_URL else None
+        )
+        PORT = int(os.getenv('PORT', '8080'))
+
+        import telebot
+
+        # Создание бота; обработчики выполняет ChatDispatcher, а не потоки telebot
+        bot = telebot.TeleBot(token, parse_mode='HTML', threaded=False)
+        # Все вызовы Bot API проходят через отправитель, который меряет задержку и считает 429
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram_request_sender
+        register_handlers(bot)
+
+    with startup_phase('catalog', durations):
+        # Крайний срок ожидания каждого источника; по умолчанию берется из описания источника
+        source_deadline = os.getenv('SOURCE_DEADLINE')
+        source_deadline = float(source_deadline) if source_deadline else None
+
+        # Каталог обновляется в фоне, обработчики читают готовый снимок без обращения к сайтам
+        refresh_interval = int(os.getenv('CATALOG_REFRESH_INTERVAL', '300'))
+        # Вежливый обход сайтов: не больше CRAWL_CONCURRENCY запросов одновременно и CRAWL_RATE в секунду к одному сайту
+        crawler = Crawler(
+            concurrency_per_host=int(os.getenv('CRAWL_CONCURRENCY', '2')),
+            rate_per_host=float(os.getenv('CRAWL_RATE', '2')),
+        )
+        # Предохранитель источника: после BREAKER_FAILURES неудач подряд сайт не опрашивается
+        # от BREAKER_BASE_DELAY до BREAKER_MAX_DELAY секунд, а его объявления берутся из последнего удачного парсинга
+        parsers.configure_breakers(
+            failure_threshold=int(os.getenv('BREAKER_FAILURES', '3')),
+            base_delay=float(os.getenv('BREAKER_BASE_DELAY', '60')),
+            max_delay=float(os.getenv('BREAKER_MAX_DELAY', '3600')),
+        )
 
-# Создание бота
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
+        # Последний снимок хранится на диске, чтобы после перезапуска сразу отвечать из него
+        store_path = os.getenv('SNAPSHOT_STORE_PATH', 'catalog.sqlite3')
+        snapshot_store = SnapshotStore(store_path)
+
+        # Несколько процессов бота на одном хосте делят один каталог: сайты опрашивает только
+        # владелец блокировки, остальные раз в CATALOG_FOLLOW_INTERVAL секунд читают опубликованный им снимок
+        catalog = Catalog(
+            partial(parse_all_cars, deadline=source_deadline, crawler=crawler),
+            refresh_interval=refresh_interval,
+            leader=FileLock(os.getenv('CATALOG_LOCK_PATH', store_path + '.lock')),
+            follow=snapshot_store.load_if_newer,
+            follow_interval=float(os.getenv('CATALOG_FOLLOW_INTERVAL', '5')),
+        )
+        catalog.add_listener(persist_catalog)
+
+        # Снимок старше этого считается устаревшим, и /health сообщает о деградации
+        CATALOG_MAX_AGE = int(os.getenv('CATALOG_MAX_AGE', str(refresh_interval * 3)))
+        # Допустимое время без успешного getUpdates в режиме polling
+        POLLING_MAX_LAG = int(os.getenv('POLLING_MAX_LAG', '120'))
+
+        # Сколько карточек марки отправлять за раз; остальные - по кнопке "Показать ещё"
+        CARDS_CHUNK_SIZE = max(1, int(os.getenv('CARDS_CHUNK_SIZE', '10')))
+        # Готовые тексты и клавиатуры для текущего содержимого каталога
+        render_cache = RenderCache(max_entries=int(os.getenv('RENDER_CACHE_SIZE', '10000')))
+
+    with startup_phase('delivery', durations):
+        # Очередь исходящих сообщений с учетом лимитов Telegram
+        send_queue = SendQueue(
+            global_rate=float(os.getenv('SEND_GLOBAL_RATE', '30')),
+            chat_rate=float(os.getenv('SEND_CHAT_RATE', '1')),
+            workers=int(os.getenv('SEND_WORKERS', '4')),
+        )
 
-# Функция для парсинга сайта antiqcar.ru
-def parse_antiqcar():
-    url = "https://antiqcar.ru/market"
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.5',
-        }
-
-        # Создаем сессию с отключенным использованием переменных окружения для прокси
-        session = requests.Session()
-        session.trust_env = False
-
-        response = session.get(url, headers=headers, timeout=15)
-        response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        cars = []
-
-        # Ищем все карточки автомобилей
-        car_items = soup.select('div.flex-item.mix')
-
-        for item in car_items:
-            try:
-                # Проверяем, не продан ли автомобиль
-                item_classes = ' '.join(item.get('class', [])).lower()
-                if 'sold' in item_classes or 'onsale' not in item_classes:
-                    continue
-
-                # Проверяем наличие текста "Продано" в карточке
-                if "продано" in str(item).lower():
-                    continue
-
-                # Проверяем, не является ли это детским автомобилем
-                children_brand_span = item.select_one('span[data-brand="Авто для детей"]')
-                is_children = children_brand_span is not None
-
-                # Извлекаем бренд из data-brand
-                brand_value = "Неизвестно"
-                # Сначала ищем в span с data-brand
-                brand_span = item.select_one('span[data-brand]')
-                if brand_span:
-                    brand_value = brand_span.get('data-brand', 'Неизвестно')
-                else:
-                    # Если нет, пытаемся извлечь из названия
-                    name_tag = item.select_one('h2.left strong, h2.left b')
-                    if name_tag:
-                        name_text = name_tag.text.strip()
-                        brand_match = re.search(r'^([A-Za-zА-Яа-я]+(?:[\s\-][A-Za-zА-Яа-я]+)*)', name_text)
-                        if brand_match:
-                            brand_value = brand_match.group(1).strip()
-
-                # Ищем название автомобиля
-                name_tag = item.select_one('h2.left strong, h2.left b')
-                name = "Неизвестный автомобиль"
-                if name_tag:
-                    name = name_tag.text.strip()
-
-                # Ищем фото автомобиля (data-src)
-                photo_tag = item.select_one('img.lazyload[data-src]')
-                photo_url = None
-                if photo_tag:
-                    photo_url = photo_tag.get('data-src')
-                    if photo_url and not photo_url.startswith('http'):
-                        photo_url = urljoin(url, photo_url)
-                    photo_url = photo_url.strip()
-
-                # Ищем цену (div с классом right2)
-                price_tag = item.select_one('div.right2 strong')
-                price = "Цена по запросу"
-                if price_tag:
-                    price = price_tag.text.strip()
-                    price = re.sub(r'\s+', ' ', price).strip()
-
-                # Ищем ссылку на автомобиль
-                link_tag = item.select_one('a[href]')
-                link = ""
-                if link_tag:
-                    link = link_tag['href']
-                    if link and not link.startswith('http'):
-                        link = urljoin(url, link)
-
-                # Ищем информацию о наличии
-                location_tag = item.select_one('div.right2 span[style*="font-size:8pt"]')
-                location = "Город не указан"
-                if location_tag:
-                    # Берем текст целиком без извлечения только города
-                    location = location_tag.text.strip()
-
-                # Определяем категорию
-                category = 'retro'
-                if is_children:
-                    category = 'children'
-
-                # Добавляем автомобиль в список
-                if name != "Неизвестный автомобиль" and brand_value != "Неизвестно" and brand_value:
-                    cars.append({
-                        'name': name,
-                        'brand': brand_value,
-                        'price': price,
-                        'photo': photo_url,
-                        'link': link,
-                        'location': location,  # Теперь содержит полный текст "В наличии в Москве"
-                        'year': "Год не указан",
-                        'source': 'antiqcar',
-                        'category': category
-                    })
-            except Exception as e:
-                logger.error(f"Ошибка при обработке карточки antiqcar: {e}")
-                continue
-
-        return cars
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка сети при парсинге antiqcar: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка при парсинге antiqcar: {e}")
-        return []
+        # Кэш file_id загруженных фото, общий для процессов бота, и фоновая проверка новых ссылок после каждого парсинга
+        photo_cache = PhotoCache(os.getenv('PHOTO_CACHE_PATH', 'photo_cache.sqlite3'))
+        # Проверки фото делят с обходом лимиты сайта: CRAWL_RATE и CRAWL_CONCURRENCY на хост
+        photo_prefetcher = PhotoPrefetcher(photo_cache, http_client, crawler=crawler)
+        # С каждым новым снимком подхватываем file_id и битые ссылки, записанные другими процессами
+        catalog.add_listener(photo_cache.reload)
+        catalog.add_listener(photo_cache.reload, followed=True)
+        catalog.add_listener(photo_prefetcher.prefetch)
+
+        sender = TelegramSender(bot, send_queue, photo_cache=photo_cache)
+
+        # Входящие обновления: порядок внутри чата сохраняется, разные чаты обрабатываются параллельно
+        dispatcher = ChatDispatcher(
+            process_update,
+            workers=int(os.getenv('UPDATE_WORKERS', '8')),
+            max_pending=int(os.getenv('UPDATE_QUEUE_SIZE', '1000')),
+        )
 
-# Функция для парсинга сайта antarmotors.ru
-def parse_antarmotors():
-    url = "https://antarmotors.ru/market"
+        # Подписки на марки и категории и рассылка изменений каталога после каждого обновления
+        subscriptions = SubscriptionStore(os.getenv('SUBSCRIPTIONS_PATH', 'subscriptions.sqlite3'))
+        notifier = ChangeNotifier(subscriptions, sender, broadcast_rate=float(os.getenv('BROADCAST_RATE', '20')))
+        catalog.add_listener(notifier.on_refresh)
+        catalog.add_listener(notifier.follow, followed=True)
+
+    with startup_phase('web', durations):
+        app = create_web_app()
+
+    with startup_phase('restore', durations):
+        # Поднимаем сохраненный каталог, чтобы отвечать из него до первого парсинга
+        restore_catalog()
+        notifier.prime(catalog.snapshot())
+
+    if start:
+        with startup_phase('start', durations):
+            catalog.start()
+            notifier.start()
+            send_queue.start()
+            dispatcher.start()
+
+    elapsed = time.perf_counter() - started
+    STARTUP_DURATION.set(elapsed, phase='total')
+    phases = ', '.join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in durations.items())
+    budget = float(os.getenv('STARTUP_BUDGET', str(STARTUP_BUDGET)))
+    if elapsed > budget:
+        logger.warning(f"Запуск занял {elapsed:.2f} с при бюджете {budget:.2f} с: {phases}")
+    else:
+        logger.info(f"Приложение собрано за {elapsed * 1000:.0f} мс: {phases}")
+    return app
+
+def register_handlers(bot):
+    """Регистрирует обработчики бота; порядок важен - общий обработчик текста последний"""
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(show_subscriptions, commands=['subscriptions'])
+    bot.register_message_handler(handle_message, func=lambda message: True)
+    bot.register_callback_query_handler(handle_callback, func=lambda call: True)
+    bot.register_inline_handler(handle_inline_query, func=lambda query: True)
+
+def restore_catalog():
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.5',
-        }
-
-        # Создаем сессию с отключенным использованием переменных окружения для прокси
-        session = requests.Session()
-        session.trust_env = False
-
-        response = session.get(url, headers=headers, timeout=15)
-        response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        cars = []
-
-        # Ищем все карточки автомобилей
-        car_items = soup.select('div.flex-item.mix')
-
-        for item in car_items:
-            try:
-                # Проверяем, не продан ли автомобиль
-                item_classes = ' '.join(item.get('class', [])).lower()
-                if 'sold' in item_classes or 'onsale' not in item_classes:
-                    continue
-
-                # Проверяем наличие текста "Продано" в карточке
-                if "продано" in str(item).lower():
-                    continue
-
-                # Проверяем, не является ли это детским автомобилем
-                children_brand_span = item.select_one('span[data-brand="Авто для детей"]')
-                is_children = children_brand_span is not None
-
-                # Извлекаем бренд из data-brand
-                brand_value = "Неизвестно"
-                # Сначала ищем в span с data-brand
-                brand_span = item.select_one('span[data-brand]')
-                if brand_span:
-                    brand_value = brand_span.get('data-brand', 'Неизвестно')
-                else:
-                    # Если нет, пытаемся извлечь из названия
-                    name_tag = item.select_one('h2.left strong, h2.left b')
-                    if name_tag:
-                        name_text = name_tag.text.strip()
-                        brand_match = re.search(r'^([A-Za-zА-Яа-я]+(?:[\s\-][A-Za-zА-Яа-я]+)*)', name_text)
-                        if brand_match:
-                            brand_value = brand_match.group(1).strip()
-
-                # Ищем название автомобиля
-                name_tag = item.select_one('h2.left strong, h2.left b')
-                name = "Неизвестный автомобиль"
-                if name_tag:
-                    name = name_tag.text.strip()
-
-                # Ищем фото автомобиля (data-src)
-                photo_tag = item.select_one('img.lazyload[data-src]')
-                photo_url = None
-                if photo_tag:
-                    photo_url = photo_tag.get('data-src')
-                    if photo_url and not photo_url.startswith('http'):
-                        photo_url = urljoin(url, photo_url)
-                    photo_url = photo_url.strip()
-
-                # Ищем цену (div с классом right2)
-                price_tag = item.select_one('div.right2 strong')
-                price = "Цена по запросу"
-                if price_tag:
-                    price = price_tag.text.strip()
-                    price = re.sub(r'\s+', ' ', price).strip()
-
-                # Ищем ссылку на автомобиль
-                link_tag = item.select_one('a[href]')
-                link = ""
-                if link_tag:
-                    link = link_tag['href']
-                    if link and not link.startswith('http'):
-                        link = urljoin(url, link)
-
-                # Ищем информацию о наличии
-                location_tag = item.select_one('div.right2 span[style*="font-size:8pt"]')
-                location = "Город не указан"
-                if location_tag:
-                    # Берем текст целиком без извлечения только города
-                    location = location_tag.text.strip()
-
-                # Определяем категорию
-                category = 'new'
-                if is_children:
-                    category = 'children'
-
-                # Добавляем автомобиль в список
-                if name != "Неизвестный автомобиль" and brand_value != "Неизвестно" and brand_value:
-                    cars.append({
-                        'name': name,
-                        'brand': brand_value,
-                        'price': price,
-                        'photo': photo_url,
-                        'link': link,
-                        'location': location,  # Теперь содержит полный текст "В наличии в Москве"
-                        'year': "Год не указан",
-                        'source': 'antarmotors',
-                        'category': category
-                    })
-            except Exception as e:
-                logger.error(f"Ошибка при обработке карточки antarmotors: {e}")
-                continue
-
-        return cars
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка сети при парсинге antarmotors: {e}")
-        return []
+        pages, validators = snapshot_store.load_pages()
+        parsers.parsed_pages.update(pages)
+        http_client.load_validators(validators)
+        catalog.restore(snapshot_store.load_snapshot())
+        # Если источник недоступен с самого запуска, отдаем его объявления из сохраненного снимка
+        snapshot = catalog.snapshot()
+        if snapshot is not None:
+            parsers.remember_cars(snapshot.cars, snapshot.created_at)
     except Exception as e:
-        logger.error(f"Ошибка при парсинге antarmotors: {e}")
-        return []
+        logger.error(f"Не удалось загрузить сохраненный каталог: {e}")
 
-# Основная функция для парсинга всех сайтов
-def parse_all_cars():
-    cars = []
+def persist_catalog(snapshot):
+    snapshot_store.save(snapshot, pages=dict(parsers.parsed_pages), validators=http_client.export_validators())
 
-    # Парсим ретро автомобили
-    antiqcar_cars = parse_antiqcar()
-    cars.extend(antiqcar_cars)
+HANDLER_DURATION = metrics.histogram('car_bot_handler_duration_seconds', 'Время работы обработчиков бота', ('handler',))
+UPDATE_LAG = metrics.histogram('car_bot_update_lag_seconds', 'Задержка от отправки сообщения до начала обработки', ('mode',))
 
-    # Парсим новые автомобили
-    antarmotors_cars = parse_antarmotors()
-    cars.extend(antarmotors_cars)
+def process_update(update):
+    message = update.message or update.edited_message
+    if message is not None and message.date:
+        UPDATE_LAG.observe(max(0, time.time() - message.date), mode='webhook' if WEBHOOK_URL else 'polling')
 
-    return cars
+    if update.callback_query is not None:
+        kind = 'callback'
+    elif update.inline_query is not None:
+        kind = 'inline'
+    else:
+        kind = 'message'
+    # Корневой интервал обновления: вызовы API и сборка ответов внутри - вложенные этапы
+    with profiling.span('update', kind=kind):
+        bot.process_new_updates([update])
+
+# Время последнего успешного getUpdates; None в режиме вебхука
+last_poll_at = None
+# В режиме polling getUpdates вызывает только лидер, остальные копии бота ждут в резерве
+polling_standby = False
+
+def catalog_cars():
+    snapshot = catalog.snapshot()
+    if snapshot is None:
+        return None
+    return {(category or ALL_CATEGORIES,): len(index.cars) for category, index in snapshot.categories.items()}
+
+def dispatcher_metrics():
+    return {(name,): value for name, value in dispatcher.stats().items()}
+
+metrics.gauge('car_bot_catalog_age_seconds', 'Возраст текущего снимка каталога', func=lambda: catalog.age)
+metrics.gauge('car_bot_catalog_cars', 'Автомобилей в снимке по категориям', ('category',), func=catalog_cars)
+metrics.gauge('car_bot_updates', 'Состояние очереди входящих обновлений', ('stat',), func=dispatcher_metrics)
+metrics.gauge('car_bot_send_queue_pending', 'Сообщений в очереди отправки', func=lambda: send_queue.pending)
+metrics.gauge('car_bot_subscriptions', 'Активных подписок', func=lambda: subscriptions.count)
+metrics.gauge(
+    'car_bot_polling_lag_seconds', 'Время с последнего успешного getUpdates',
+    func=lambda: time.time() - last_poll_at if last_poll_at is not None else None
+)
+
+CATEGORY_TITLES = {
+    'retro': "Ретро",
+    'new': "Новые",
+    'children': "Детские",
+    ALL_CATEGORIES: "Все автомобили",
+}
+
+CATALOG_LOADING_TEXT = "⏳ Каталог автомобилей загружается, попробуйте через минуту."
+CATALOG_CHANGED_TEXT = "Каталог обновился, откройте список марок заново"
+
+# Результатов inline-поиска в одном ответе (Telegram принимает до 50)
+INLINE_PAGE_SIZE = 20
+
+# Фильтры списка автомобилей: (название, выборка из индекса категории).
+# Порядок важен - в кнопках хранится номер фильтра
+CAR_FILTERS = (
+    ("💰 Сначала дешевые", lambda index: index.cheapest()),
+    ("до 10 млн ₽", lambda index: index.price_range(high=10000000)),
+    ("10-30 млн ₽", lambda index: index.price_range(10000000, 30000000)),
+    ("30-60 млн ₽", lambda index: index.price_range(30000000, 60000000)),
+    ("от 60 млн ₽", lambda index: index.price_range(low=60000000)),
+    ("📅 до 1960 г.", lambda index: index.year_range(high=1960)),
+    ("📅 1960-1989", lambda index: index.year_range(1960, 1990)),
+    ("📅 1990-2019", lambda index: index.year_range(1990, 2020)),
+    ("📅 с 2020 г.", lambda index: index.year_range(low=2020)),
+)
+
+def main_menu_markup():
+    from telebot import types
 
-# Обработчик команды /start
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     # Первая кнопка "Все автомобили" во всю строку
     markup.row(types.KeyboardButton("🔍 Все автомобили"))
@@ -300,7 +325,16 @@ def send_welcome(message):
     )
     # Кнопка помощи
     markup.row(types.KeyboardButton("ℹ️ Помощь"))
+    return markup
 
+@lru_cache(maxsize=None)
+def main_menu():
+    """Главное меню не меняется - сериализуем его один раз"""
+    return main_menu_markup().to_json()
+
+# Обработчик команды /start
+@metrics.timed(HANDLER_DURATION, handler='start')
+def send_welcome(message):
     welcome_text = """<b>Мы - Сообщество автомобильных энтузиастов прекрасно понимаем: иногда нужно купить авто сразу, а иногда – найти именно ту уникальную модель, которая покорила ваше сердце.</b>
 
 • Готовые решения: На нашем складе и площадках всегда представлен тщательно подобранный парк автомобилей из наличия. Это проверенные, подготовленные к передаче машины различных марок, моделей и комплектаций.
@@ -319,10 +353,41 @@ def send_welcome(message):
 
 Нажмите на кнопку ниже для начала поиска."""
 
-    bot.reply_to(message, welcome_text, reply_markup=markup, disable_web_page_preview=True)
+    sender.reply_to(message, welcome_text, reply_markup=main_menu(), disable_web_page_preview=True)
+
+# Обработчик команды /subscriptions - список подписок с кнопками отписки
+@metrics.timed(HANDLER_DURATION, handler='subscriptions')
+def show_subscriptions(message):
+    from telebot import types
+
+    chat_subscriptions = subscriptions.for_chat(message.chat.id)
+    if not chat_subscriptions:
+        sender.reply_to(message, "🔕 У вас нет подписок. Подписаться можно из списка марок или карточек марки.")
+        return
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    lines = []
+    for kind, value in chat_subscriptions:
+        if kind == 'category':
+            title = f"категория «{CATEGORY_TITLES.get(value, value)}»"
+        else:
+            brand = None
+            snapshot = catalog.snapshot()
+            if snapshot is not None:
+                brand = snapshot.category(None).brand(value)
+            title = f"марка {brand.display_name if brand else value}"
+        lines.append(f"• {title}")
+        if kind == 'category':
+            callback_data = callbacks.encode(callbacks.UNSUBSCRIBE_CATEGORY, None if value == ALL_CATEGORIES else value)
+        else:
+            callback_data = callbacks.encode(callbacks.UNSUBSCRIBE_BRAND, version=callbacks.key_checksum(value))
+        markup.add(types.InlineKeyboardButton(f"🔕 Отписаться: {title}", callback_data=callback_data))
+
+    text = "<b>🔔 Ваши подписки:</b>\n\n" + "\n".join(lines) + "\n\nВы получаете уведомления о новых поступлениях, изменении цены и снятии с продажи."
+    sender.reply_to(message, text, reply_markup=markup)
 
 # Обработчик текстовых сообщений
-@bot.message_handler(func=lambda message: True)
+@metrics.timed(HANDLER_DURATION, handler='message')
 def handle_message(message):
     if message.text == "🚗 Ретро":
         show_brands(message, category='retro')
@@ -334,25 +399,22 @@ def handle_message(message):
         show_brands(message, category=None)
     elif message.text == "ℹ️ Помощь":
         show_help(message)
+    elif message.via_bot is not None:
+        # Карточка, отправленная через inline-поиск, - отвечать не нужно
+        return
     else:
-        bot.reply_to(message, "Пожалуйста, используйте кнопки меню.")
+        sender.reply_to(message, "Пожалуйста, используйте кнопки меню.")
 
 def show_brands(message, category=None, page=1):
-    msg = bot.send_message(message.chat.id, "⏳ Ищу доступные марки автомобилей...")
+    snapshot = catalog.snapshot()
+    if snapshot is None:
+        sender.respond(message.chat.id, CATALOG_LOADING_TEXT)
+        return
 
-    cars = parse_all_cars()
-
-    # Фильтруем по категории
-    if category:
-        cars = [car for car in cars if car.get('category') == category]
-
-    # Удаляем предыдущее сообщение "Ищу..."
-    try:
-        bot.delete_message(message.chat.id, msg.message_id)
-    except:
-        pass
+    # Берем готовый индекс категории
+    index = snapshot.category(category)
 
-    if not cars:
+    if not index.cars:
         # Если нет детских автомобилей, показываем специальное сообщение
         if category == 'children':
             error_msg = """ℹ️ В настоящее время в категории "Детские" нет доступных моделей.
@@ -360,18 +422,7 @@ def show_brands(message, category=None, page=1):
 Проверьте, пожалуйста, позже. Возможно, информация обновится.
 
 Вы можете вернуться в главное меню:"""
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            # Первая кнопка "Все автомобили" во всю строку
-            markup.row(types.KeyboardButton("🔍 Все автомобили"))
-            # Три кнопки в одну строку
-            markup.row(
-                types.KeyboardButton("🚘 Новые"),
-                types.KeyboardButton("🚗 Ретро"),
-                types.KeyboardButton("👶 Детские")
-            )
-            # Кнопка помощи
-            markup.row(types.KeyboardButton("ℹ️ Помощь"))
-            bot.reply_to(message, error_msg, reply_markup=markup)
+            sender.reply_to(message, error_msg, reply_markup=main_menu())
             return
         else:
             error_msg = """❌ Не удалось загрузить список автомобилей.
@@ -382,32 +433,27 @@ def show_brands(message, category=None, page=1):
 3. Требуется обновление парсера
 
 Попробуйте позже или свяжитесь с поддержкой."""
-            bot.reply_to(message, error_msg)
+            sender.reply_to(message, error_msg)
             return
 
-    # Группируем по брендам, используя оригинальное значение
-    brands = {}
-    for car in cars:
-        # Используем оригинальное значение brand для группировки
-        brand_key = car['brand'].lower().strip()
+    response, markup = cached_brands(snapshot, index, category, page)
+    sender.respond(message.chat.id, response, reply_markup=markup)
 
-        if brand_key not in brands:
-            brands[brand_key] = {
-                'display_name': car['brand'],  # Сохраняем оригинальное значение для отображения
-                'cars': []
-            }
-
-        brands[brand_key]['cars'].append(car)
+def cached_brands(snapshot, index, category, page):
+    return render_cache.get(
+        snapshot.content_hash, ('brands', category, page),
+        lambda: render_brands(snapshot, index, category, page)
+    )
 
-    # Сортируем марки по алфавиту
-    sorted_brands = sorted(brands.items(), key=lambda x: x[1]['display_name'])
+def render_brands(snapshot, index, category, page):
+    """Текст и сериализованная клавиатура страницы списка марок из готового индекса"""
+    from telebot import types
 
-    # Пагинация
-    brands_per_page = 15
-    total_pages = max(1, (len(sorted_brands) + brands_per_page - 1) // brands_per_page)
-    start_idx = (page - 1) * brands_per_page
-    end_idx = start_idx + brands_per_page
-    current_page_brands = sorted_brands[start_idx:end_idx]
+    # Пагинация по заранее нарезанным страницам
+    brands_per_page = index.per_page
+    total_pages = index.total_pages
+    page = min(max(page, 1), total_pages)
+    current_page_brands = index.page(page)
 
     # Определяем заголовок в зависимости от категории
     if category == 'retro':
@@ -421,8 +467,8 @@ def show_brands(message, category=None, page=1):
 
     # Отправляем список марок
     response = f"<b>🔤 Доступные марки {header} (страница {page} из {total_pages}):</b>\n\n"
-    for i, (brand_key, brand_data) in enumerate(current_page_brands, 1):
-        response += f"{(page-1)*brands_per_page + i}. <b>{brand_data['display_name']}</b> - {len(brand_data['cars'])} моделей\n"
+    for i, brand in enumerate(current_page_brands, 1):
+        response += f"{(page-1)*brands_per_page + i}. <b>{brand.display_name}</b> - {brand.count} моделей\n"
 
     response += "\nВыберите марку из списка ниже:"
 
@@ -430,15 +476,14 @@ def show_brands(message, category=None, page=1):
     markup = types.InlineKeyboardMarkup(row_width=1)
 
     # Добавляем кнопки для марок на текущей странице
-    for brand_key, brand_data in current_page_brands:
-        # Формируем callback_data в зависимости от наличия категории
-        if category:
-            callback_data = f"brand_{brand_key}_{category}"
-        else:
-            callback_data = f"brand_{brand_key}"
+    for brand in current_page_brands:
+        # В кнопку кладем номер марки в снимке, а не ее название
+        callback_data = callbacks.encode(
+            callbacks.BRAND, category, snapshot.version, snapshot.brand_ids[brand.key]
+        )
 
         btn = types.InlineKeyboardButton(
-            f"{brand_data['display_name']} ({len(brand_data['cars'])})", 
+            f"{brand.display_name} ({brand.count})", 
             callback_data=callback_data
         )
         markup.add(btn)
@@ -446,20 +491,35 @@ def show_brands(message, category=None, page=1):
     # Добавляем навигацию по страницам
     pagination_row = []
     if page > 1:
-        if category:
-            pagination_row.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"page_{page-1}_{category}"))
-        else:
-            pagination_row.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"page_{page-1}"))
+        pagination_row.append(types.InlineKeyboardButton("◀️ Назад", callback_data=callbacks.encode(callbacks.PAGE, category, page=page-1)))
     if page < total_pages:
-        if category:
-            pagination_row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"page_{page+1}_{category}"))
-        else:
-            pagination_row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"page_{page+1}"))
+        pagination_row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=callbacks.encode(callbacks.PAGE, category, page=page+1)))
 
     if pagination_row:
         markup.row(*pagination_row)
 
-    bot.send_message(message.chat.id, response, reply_markup=markup)
+    # Фильтры по цене и году и подписка на новинки категории
+    markup.add(types.InlineKeyboardButton("🔎 Фильтры и сортировка", callback_data=callbacks.encode(callbacks.FILTER_MENU, category)))
+    markup.add(types.InlineKeyboardButton("🔔 Уведомлять о новинках", callback_data=callbacks.encode(callbacks.SUBSCRIBE_CATEGORY, category)))
+
+    return response, markup.to_json()
+
+def render_filters(index, category):
+    """Текст и клавиатура меню фильтров категории с числом подходящих автомобилей"""
+    from telebot import types
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        types.InlineKeyboardButton(
+            f"{title} ({len(select(index))})",
+            callback_data=callbacks.encode(callbacks.FILTER, category, brand_id=filter_id)
+        )
+        for filter_id, (title, select) in enumerate(CAR_FILTERS)
+    ])
+    markup.row(types.InlineKeyboardButton("◀️ К списку марок", callback_data=callbacks.encode(callbacks.PAGE, category, page=1)))
+
+    text = f"<b>🔎 {CATEGORY_TITLES[category or ALL_CATEGORIES]}: фильтры и сортировка</b>\n\nВыберите диапазон цены, год выпуска или порядок показа:"
+    return text, markup.to_json()
 
 def show_help(message):
     help_text = """<b>ℹ️ Помощь по использованию бота</b>
@@ -467,154 +527,409 @@ def show_help(message):
 
 <b>Как использовать:</b>
 1. Нажмите на кнопку "Все автомобили", "Новые", "Ретро" или "Детские"
-2. Выберите интересующую вас марку
+2. Выберите интересующую вас марку или откройте «🔎 Фильтры и сортировка», чтобы подобрать автомобиль по цене и году
 3. Получите информацию об автомобилях
 
 
 <b>Важно:</b> 
 • Бот показывает только автомобили, которые находятся в наличии
-• Каждый автомобиль отображается в отдельном сообщении с фото (если доступно)
+• Автомобили с фото приходят альбомами до 10 карточек, без фото - отдельными сообщениями; следующие карточки марки - по кнопке "Показать ещё"
 • Для уточнения деталей используйте ссылки на сайт
+• Поиск в любом чате: наберите @имя_бота и название, марку или город, например «мерседес»
+• Подпишитесь на марку или категорию кнопкой 🔔, чтобы получать новые поступления и изменения цен. Список подписок: /subscriptions
 
 ☎️ <b>+79037240147</b> (WhatsApp, Telegram)
 
 Для начала работы нажмите /start"""
 
-    bot.send_message(message.chat.id, help_text, disable_web_page_preview=True)
+    sender.respond(message.chat.id, help_text, disable_web_page_preview=True)
 
 # Обработчик callback-запросов
-@bot.callback_query_handler(func=lambda call: True)
+@metrics.timed(HANDLER_DURATION, handler='callback')
 def handle_callback(call):
     try:
-        if call.data.startswith("brand_"):
-            parts = call.data.split("_")
-            brand_key = parts[1]
-            category = parts[2] if len(parts) > 2 else None
-
-            cars = parse_all_cars()
-
-            # Фильтруем по категории
-            if category:
-                cars = [car for car in cars if car.get('category') == category]
-
-            # Фильтруем по оригинальному значению бренда
-            brand_cars = [car for car in cars if car['brand'].lower().strip() == brand_key]
-
-            if not brand_cars:
-                bot.answer_callback_query(call.id, "Не удалось найти автомобили этой марки")
-                return
-
-            # Находим оригинальное название марки
-            original_brand = brand_cars[0]['brand']
-
-            # Отправляем информацию об автомобилях этой марки
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=f"🚗 <b>Автомобили марки {original_brand}:</b>",
-                parse_mode='HTML'
-            )
-
-            # Отправляем каждый автомобиль в отдельном сообщении
-            for i, car in enumerate(brand_cars, 1):
-                car_info = f"<b>#{i} {car['name']}</b>\n\n"
-
-                # Для новых авто показываем год, для ретро - нет
-                if car.get('category') == 'new' and car['year'] != "Год не указан":
-                    car_info += f"📅 <b>Год выпуска:</b> {car['year']}\n"
-
-                # Используем полный текст о наличии
-                car_info += f"📍 <b>Наличие:</b> {car['location']}\n"
-
-                car_info += f"💰 <b>Цена:</b> {car['price']}"
-
-                if car.get('link'):
-                    car_info += f"\n\n🔗 <a href='{car['link']}'>Подробнее на сайте</a>"
-
-                # Добавляем контакт внизу карточки
-                car_info += f"\n\n☎️ <b>+79037240147</b> (WhatsApp, Telegram)"
-
-                # Отправляем фото и описание отдельными сообщениями
-                if car.get('photo'):
-                    try:
-                        bot.send_photo(
-                            call.message.chat.id, 
-                            car['photo'],
-                            caption=car_info
-                        )
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки фото: {e}")
-                        bot.send_message(
-                            call.message.chat.id, 
-                            f"⚠️ Фото недоступно\n\n{car_info}",
-                            disable_web_page_preview=True
-                        )
-                else:
-                    bot.send_message(
-                        call.message.chat.id, 
-                        car_info,
-                        disable_web_page_preview=True
-                    )
-
-                # Небольшая пауза между отправкой
-                time.sleep(0.5)
-
-            # Кнопка для возврата
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            # Первая кнопка "Все автомобили" во всю строку
-            markup.row(types.KeyboardButton("🔍 Все автомобили"))
-            # Три кнопки в одну строку
-            markup.row(
-                types.KeyboardButton("🚘 Новые"),
-                types.KeyboardButton("🚗 Ретро"),
-                types.KeyboardButton("👶 Детские")
-            )
-            # Кнопка помощи
-            markup.row(types.KeyboardButton("ℹ️ Помощь"))
-
-            bot.send_message(
-                call.message.chat.id,
-                "✅ Загрузка завершена! Выберите следующее действие:",
-                reply_markup=markup
-            )
-
-        elif call.data.startswith("page_"):
-            parts = call.data.split("_")
-            page = int(parts[1])
-            category = parts[2] if len(parts) > 2 else None
-
-            # Редактируем текущее сообщение, заменяя его на новую страницу
-            bot.edit_message_reply_markup(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                reply_markup=None
-            )
-            # Отправляем новую страницу
-            show_brands(call.message, category=category, page=page)
+        token = callbacks.decode(call.data)
+        if token is not None and token.action in SUBSCRIPTION_ACTIONS:
+            handle_subscription(call, token)
+
+        elif token is not None:
+            handle_token(call, token)
+
+        # Кнопки подписки из сообщений, отправленных до перехода на компактный формат
+        elif call.data.startswith("subcat_"):
+            category = call.data[len("subcat_"):]
+            subscriptions.subscribe(call.message.chat.id, 'category', category)
+            sender.answer_callback_query(call.id, f"🔔 Вы подписаны на новинки: {CATEGORY_TITLES.get(category, category)}")
+
+        elif call.data.startswith("unsub_"):
+            _, kind, value = call.data.split("_", 2)
+            subscriptions.unsubscribe(call.message.chat.id, kind, value)
+            sender.answer_callback_query(call.id, "🔕 Подписка отменена")
+
+        else:
+            # Кнопки старого формата
+            sender.answer_callback_query(call.id, CATALOG_CHANGED_TEXT)
 
     except Exception as e:
-        bot.send_message(call.message.chat.id, f"❌ Произошла ошибка: {str(e)}")
+        sender.send_message(call.message.chat.id, f"❌ Произошла ошибка: {str(e)}")
         logger.error(f"Callback error: {e}")
 
-# Запуск веб-сервера для предотвращения засыпания на Replit
-app = Flask(__name__)
+SUBSCRIPTION_ACTIONS = (callbacks.SUBSCRIBE_CATEGORY, callbacks.UNSUBSCRIBE_CATEGORY, callbacks.UNSUBSCRIBE_BRAND)
+
+def handle_subscription(call, token):
+    """Подписка на категорию и отписка; снимок каталога для них не нужен"""
+    chat_id = call.message.chat.id
+    category = token.category or ALL_CATEGORIES
+
+    if token.action == callbacks.SUBSCRIBE_CATEGORY:
+        subscriptions.subscribe(chat_id, 'category', category)
+        sender.answer_callback_query(call.id, f"🔔 Вы подписаны на новинки: {CATEGORY_TITLES[category]}")
+        return
+
+    if token.action == callbacks.UNSUBSCRIBE_CATEGORY:
+        subscriptions.unsubscribe(chat_id, 'category', category)
+    else:
+        for kind, value in subscriptions.for_chat(chat_id):
+            if kind == 'brand' and callbacks.key_checksum(value) == token.version:
+                subscriptions.unsubscribe(chat_id, kind, value)
+    sender.answer_callback_query(call.id, "🔕 Подписка отменена")
+
+def edit_in_place(call, text, markup):
+    """Заменяет текст и клавиатуру сообщения с нажатой кнопкой"""
+    sender.edit_message_text(call.message.chat.id, call.message.message_id, text, reply_markup=markup)
+    sender.answer_callback_query(call.id)
+
+def handle_token(call, token):
+    snapshot = catalog.snapshot()
+    if snapshot is None:
+        sender.answer_callback_query(call.id, CATALOG_LOADING_TEXT)
+        return
+
+    if token.action in (callbacks.PAGE, callbacks.FILTER_MENU, callbacks.FILTER):
+        index = snapshot.category(token.category)
+        if not index.cars:
+            sender.answer_callback_query(call.id, CATALOG_CHANGED_TEXT)
+            return
+
+        if token.action == callbacks.PAGE:
+            # Перелистываем список в том же сообщении из готового индекса
+            edit_in_place(call, *cached_brands(snapshot, index, token.category, token.page))
+        elif token.action == callbacks.FILTER_MENU:
+            edit_in_place(call, *render_cache.get(
+                snapshot.content_hash, ('filters', token.category),
+                lambda: render_filters(index, token.category)
+            ))
+        else:
+            show_filtered_cars(call, snapshot, index, token.category, token.brand_id, start=token.page, version=token.version)
+        return
+
+    # Номера марок действительны только для снимка с той же версией. Продолжение порций марки -
+    # только для снимка с тем же содержимым: иначе смещение укажет в другой список карточек
+    version = snapshot.content_version if token.action == callbacks.MORE else snapshot.version
+    brand_key = snapshot.brand_key_by_id(token.brand_id) if token.version == version else None
+    if brand_key is None:
+        sender.answer_callback_query(call.id, CATALOG_CHANGED_TEXT)
+        return
+
+    if token.action == callbacks.SUBSCRIBE_BRAND:
+        subscriptions.subscribe(call.message.chat.id, 'brand', brand_key)
+        sender.answer_callback_query(call.id, "🔔 Вы подписаны на новые поступления этой марки")
+        return
+
+    if token.action == callbacks.BRAND:
+        show_brand_cars(call, snapshot, token.category, brand_key)
+
+    elif token.action == callbacks.MORE:
+        show_brand_cars(call, snapshot, token.category, brand_key, start=token.page)
+
+def remove_more_button(call):
+    # Убираем кнопку, чтобы порцию нельзя было запросить дважды
+    sender.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
+    sender.answer_callback_query(call.id)
+
+def show_brand_cars(call, snapshot, category, brand_key, start=0):
+    """Отправляет порцию из CARDS_CHUNK_SIZE карточек марки начиная с номера start"""
+    # Находим марку в индексе категории
+    brand = snapshot.category(category).brand(brand_key)
+
+    if brand is None or start >= brand.count:
+        sender.answer_callback_query(call.id, "Не удалось найти автомобили этой марки")
+        return
+
+    brand_id = snapshot.brand_ids[brand.key]
+
+    if start == 0:
+        # Отправляем информацию об автомобилях этой марки
+        text, subscribe_markup = render_cache.get(
+            snapshot.content_hash, ('brand_header', category, brand.key),
+            lambda: render_brand_header(snapshot, brand)
+        )
+        sender.edit_message_text(
+            call.message.chat.id,
+            call.message.message_id,
+            text,
+            parse_mode='HTML',
+            reply_markup=subscribe_markup
+        )
+    else:
+        # Кнопку "Показать ещё" убираем только после проверки марки: на нажатие отвечаем один раз
+        remove_more_button(call)
+
+    chunk = render_cache.get(
+        snapshot.content_hash, ('brand_cars', category, brand.key, start),
+        lambda: render_cars_chunk(
+            brand.cars, start, f"автомобилей {brand.display_name}",
+            lambda end: callbacks.encode(callbacks.MORE, category, snapshot.content_version, brand_id, end)
+        )
+    )
+    send_chunk(call.message.chat.id, chunk)
+
+def render_brand_header(snapshot, brand):
+    from telebot import types
+
+    subscribe_markup = types.InlineKeyboardMarkup()
+    subscribe_markup.add(types.InlineKeyboardButton(
+        f"🔔 Подписаться на {brand.display_name}",
+        callback_data=callbacks.encode(
+            callbacks.SUBSCRIBE_BRAND, version=snapshot.version, brand_id=snapshot.brand_ids[brand.key]
+        )
+    ))
+    return f"🚗 <b>Автомобили марки {brand.display_name}</b> ({brand.count}):", subscribe_markup.to_json()
+
+def show_filtered_cars(call, snapshot, index, category, filter_id, start=0, version=0):
+    """Отправляет порцию автомобилей категории, выбранных фильтром filter_id.
+
+    Продолжение выборки (start > 0) действительно только для снимка с тем же содержимым.
+    """
+    if filter_id >= len(CAR_FILTERS) or (start and version != snapshot.content_version):
+        sender.answer_callback_query(call.id, CATALOG_CHANGED_TEXT)
+        return
+    title, select = CAR_FILTERS[filter_id]
+    cars = select(index)
+    if start >= len(cars):
+        sender.answer_callback_query(call.id, "Нет автомобилей по этому фильтру")
+        return
+
+    if start == 0:
+        sender.answer_callback_query(call.id)
+        sender.send_message(call.message.chat.id, f"🔎 <b>{title}</b>: найдено {len(cars)}")
+    else:
+        remove_more_button(call)
+
+    chunk = render_cache.get(
+        snapshot.content_hash, ('filter_cars', category, filter_id, start),
+        lambda: render_cars_chunk(
+            cars, start, f"по фильтру «{title}»",
+            lambda end: callbacks.encode(callbacks.FILTER, category, snapshot.content_version, filter_id, end)
+        )
+    )
+    send_chunk(call.message.chat.id, chunk)
+
+def car_text(car, number=None):
+    if number is None:
+        car_info = f"<b>{car['name']}</b>\n\n"
+    else:
+        car_info = f"<b>#{number} {car['name']}</b>\n\n"
+
+    # Год показываем, если он известен: по нему работают фильтры и для ретро
+    if car.get('year_value'):
+        car_info += f"📅 <b>Год выпуска:</b> {car['year_value']}\n"
+
+    # Используем полный текст о наличии
+    car_info += f"📍 <b>Наличие:</b> {car['location']}\n"
+
+    car_info += f"💰 <b>Цена:</b> {car['price']}"
+
+    if car.get('stale'):
+        car_info += "\n\n⚠️ Сайт продавца сейчас недоступен, данные могут быть устаревшими"
+
+    if car.get('link'):
+        car_info += f"\n\n🔗 <a href='{car['link']}'>Подробнее на сайте</a>"
+
+    # Добавляем контакт внизу карточки
+    car_info += f"\n\n☎️ <b>+79037240147</b> (WhatsApp, Telegram)"
+
+    return car_info
+
+def car_card(car, number):
+    return Card(car_text(car, number), photo=car.get('photo'))
+
+def render_cars_chunk(cars, start, title, more_data):
+    """Карточки порции из CARDS_CHUNK_SIZE автомобилей начиная с start и завершающее сообщение.
+
+    Возвращает (cards, text, markup): если карточки остались, сообщение с кнопкой
+    "Показать ещё" и данными more_data(end), иначе - с главным меню.
+    """
+    from telebot import types
+
+    end = min(start + CARDS_CHUNK_SIZE, len(cars))
+    cards = [car_card(car, i) for i, car in enumerate(cars[start:end], start + 1)]
+
+    if end < len(cars):
+        # Следующую порцию отправим, только если пользователь ее попросит
+        more_markup = types.InlineKeyboardMarkup()
+        more_markup.add(types.InlineKeyboardButton(
+            f"⬇️ Показать ещё ({min(CARDS_CHUNK_SIZE, len(cars) - end)})",
+            callback_data=more_data(end)
+        ))
+        return cards, f"Показано {end} из {len(cars)} {title}", more_markup.to_json()
+
+    return cards, "✅ Загрузка завершена! Выберите следующее действие:", main_menu()
+
+def send_chunk(chat_id, chunk):
+    cards, text, markup = chunk
+    # Фото идут альбомами до 10 штук, карточки без фото - отдельными сообщениями;
+    # очередь отправки сама соблюдает лимиты Telegram
+    sender.send_cards(chat_id, cards)
+    sender.send_message(chat_id, text, reply_markup=markup)
+
+# Inline-режим: @бот запрос - поиск по названию, марке и городу в текущем снимке
+@metrics.timed(HANDLER_DURATION, handler='inline')
+def handle_inline_query(query):
+    snapshot = catalog.snapshot()
+    if snapshot is None:
+        sender.answer_inline_query(query.id, [], cache_time=5)
+        return
+
+    # Смещение привязано к содержимому снимка, чтобы страницы одного поиска не перемешались
+    version, _, offset = (query.offset or '').partition(':')
+    offset = int(offset) if version == str(snapshot.content_version) and offset.isdigit() else 0
+
+    if query.query.strip():
+        cars = snapshot.search.search(query.query)
+    else:
+        cars = snapshot.cars
+    page = cars[offset:offset + INLINE_PAGE_SIZE]
+
+    results = []
+    for car in page:
+        results.append(render_cache.get(
+            snapshot.content_hash, ('inline', listing_key(car)),
+            lambda: render_inline_result(car)
+        ))
+
+    next_offset = f"{snapshot.content_version}:{offset + INLINE_PAGE_SIZE}" if offset + INLINE_PAGE_SIZE < len(cars) else ""
+    sender.answer_inline_query(query.id, results, cache_time=60, next_offset=next_offset)
+
+def render_inline_result(car):
+    from telebot import types
+
+    return types.InlineQueryResultArticle(
+        id=hashlib.sha1(listing_key(car).encode('utf-8')).hexdigest(),
+        title=car['name'],
+        description=f"{car['price']} · {car['location']}",
+        thumbnail_url=car.get('photo') or None,
+        input_message_content=types.InputTextMessageContent(car_text(car), parse_mode='HTML'),
+    )
+
+def create_web_app():
+    """Flask-приложение: проверка работы, health, метрики и вебхук"""
+    from flask import Flask
+
+    # Веб-сервер также не дает боту заснуть на Replit
+    web_app = Flask(__name__)
+    web_app.add_url_rule('/', view_func=home)
+    web_app.add_url_rule('/health', view_func=health)
+    web_app.add_url_rule('/metrics', view_func=metrics_endpoint)
+    # В режиме polling вебхука нет: иначе любой мог бы прислать боту поддельное обновление
+    if WEBHOOK_URL:
+        web_app.add_url_rule(WEBHOOK_PATH, view_func=webhook, methods=['POST'])
+    # Без токена профилировщик не публикуется: за обратным прокси адрес клиента всегда локальный
+    if profiling.enabled and PROFILE_TOKEN:
+        web_app.add_url_rule('/debug/profile', view_func=profile)
+    elif profiling.enabled:
+        logger.warning("PROFILE_TOKEN не задан, /debug/profile отключен")
+    return web_app
 
-@app.route('/')
 def home():
+    from flask import jsonify
     return jsonify({"status": "active", "message": "Бот для поиска ретро автомобилей работает!"})
 
-@app.route('/health')
 def health():
-    return jsonify({"status": "healthy"})
+    """Готовность бота: свежий каталог, работающий прием обновлений и свободная очередь"""
+    from flask import jsonify
+
+    problems = []
+    age = catalog.age
+    if not catalog.ready:
+        problems.append("каталог еще не загружен")
+    elif not catalog.snapshot().cars:
+        problems.append("каталог пуст: ни один источник не ответил")
+    elif age is not None and age > CATALOG_MAX_AGE:
+        problems.append(f"каталог устарел: {int(age)} с")
+
+    polling_lag = None
+    if not WEBHOOK_URL and not polling_standby:
+        polling_lag = time.time() - last_poll_at if last_poll_at is not None else None
+        if polling_lag is None:
+            problems.append("polling еще не запущен")
+        elif polling_lag > POLLING_MAX_LAG:
+            problems.append(f"нет ответа getUpdates {int(polling_lag)} с")
+
+    updates = dispatcher.stats()
+    if updates['pending'] >= dispatcher.max_pending:
+        problems.append("очередь обновлений переполнена")
+
+    body = {
+        "status": "degraded" if problems else "healthy",
+        "problems": problems,
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "catalog_ready": catalog.ready,
+        "catalog_role": "leader" if catalog.is_leader else "follower",
+        "catalog_age": age,
+        "catalog_error": str(catalog.last_error) if catalog.last_error else None,
+        # Источник с разомкнутым предохранителем не делает бота неготовым: его объявления отдаются из прошлых данных
+        "sources": parsers.source_status(),
+        "polling_lag": polling_lag,
+        "polling_standby": polling_standby,
+        "updates": updates,
+        "send_queue": send_queue.pending,
+    }
+    return jsonify(body), 503 if problems else 200
+
+def metrics_endpoint():
+    from flask import Response
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def profile():
+    """Сэмплирующий профилировщик на ?seconds=N секунд; стеки в формате folded для flamegraph.pl и speedscope"""
+    from flask import Response, jsonify, request
+
+    # Стеки раскрывают устройство бота, а замер занимает поток веб-сервера - только с токеном
+    token = request.headers.get('X-Profile-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return jsonify({"status": "forbidden"}), 403
+
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILE_MAX_SECONDS)
+    folded = profiling.sample(seconds)
+    if folded is None:
+        return jsonify({"status": "busy", "message": "профилировщик уже запущен"}), 409
+    return Response(folded, mimetype='text/plain')
+
+def webhook():
+    from flask import jsonify, request
+    from telebot import types
+
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+        return jsonify({"status": "forbidden"}), 403
+
+    update = types.Update.de_json(request.get_data(as_text=True))
+    # Очередь переполнена - Telegram повторит доставку позже
+    if not dispatcher.submit(update):
+        return jsonify({"status": "busy"}), 503
+    return jsonify({"status": "ok"})
 
 def keep_alive():
     """Постоянно отправляет запросы к собственному серверу для предотвращения засыпания"""
+    import requests
+
     logger.info("Запуск keep_alive потока")
     while True:
         try:
             logger.info("Отправка keep-alive запроса")
             # Отправляем запрос к нашему же серверу
-            requests.get('http://127.0.0.1:8080/health')
+            requests.get(f'http://127.0.0.1:{PORT}/health')
             # Отправляем запрос к внешнему сервису для дополнительной активности
             requests.get('https://api.github.com')
         except Exception as e:
@@ -622,18 +937,105 @@ def keep_alive():
         time.sleep(300)  # Каждые 5 минут
 
 def run_server():
-    app.run(host='0.0.0.0', port=8080)
-
-# Запускаем веб-сервер и keep-alive в отдельных потоках
-server_thread = threading.Thread(target=run_server)
-server_thread.daemon = True
-server_thread.start()
-
-keep_alive_thread = threading.Thread(target=keep_alive)
-keep_alive_thread.daemon = True
-keep_alive_thread.start()
+    try:
+        app.run(host='0.0.0.0', port=PORT)
+    except OSError as e:
+        logger.error(f"Веб-сервер не запущен: порт {PORT} занят ({e}). У каждой копии бота должен быть свой PORT")
+
+def run_webhook():
+    """Регистрирует вебхук и обслуживает Flask-приложение многопоточным WSGI-сервером"""
+    from waitress import serve
+
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+    )
+    try:
+        serve(app, host='0.0.0.0', port=PORT, threads=int(os.getenv('WEB_THREADS', '8')))
+    except OSError as e:
+        logger.error(f"Не удалось занять порт {PORT}: {e}. У каждой копии бота должен быть свой PORT за прокси")
+        exit(1)
+
+def run_polling():
+    """Long polling: получает обновления и передает их диспетчеру.
+
+    Telegram отвечает 409 Conflict, если getUpdates одного бота вызывают несколько
+    процессов. Поэтому опрашивает только лидер каталога; остальные копии ждут в
+    резерве и начинают опрос, когда блокировка переходит к ним.
+    """
+    global last_poll_at, polling_standby
+    # Поток каталога пытается захватить блокировку сразу после запуска - ждем его первой попытки
+    deadline = time.monotonic() + catalog.follow_interval
+    while not catalog.is_leader and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if not catalog.is_leader:
+        polling_standby = True
+        logger.warning(
+            "Блокировка каталога у другого процесса: getUpdates опрашивает он, этот процесс ждет в резерве. "
+            "Чтобы обновления обрабатывали все копии бота, нужен режим вебхука (WEBHOOK_URL) "
+            "со своим PORT у каждой копии за прокси"
+        )
+        while not catalog.is_leader:
+            time.sleep(catalog.follow_interval)
+        polling_standby = False
+        logger.info("Процесс стал лидером и начинает опрос getUpdates")
+
+    bot.remove_webhook()
+    offset = None
+    last_poll_at = time.time()
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            time.sleep(3)
+            continue
+        last_poll_at = time.time()
+
+        for update in updates:
+            offset = update.update_id + 1
+            # Если обработчики не успевают, ждем места в очереди, а не теряем обновление
+            dispatcher.submit(update, block=True)
+
+def main():
+    """Точка входа: окружение и .env, сборка приложения и прием обновлений"""
+    logging.basicConfig(level=logging.INFO)
+    os.environ['no_proxy'] = '*'
+    os.environ['NO_PROXY'] = '*'
+
+    # Загрузка переменных окружения
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if not os.getenv('BOT_TOKEN'):
+        logger.error("ОШИБКА: BOT_TOKEN не найден. Проверьте Secrets!")
+        exit(1)
+
+    create_app()
+
+    # В режиме polling запускаем веб-сервер и keep-alive в отдельных потоках;
+    # в режиме вебхука Telegram сам обращается к серверу, и keep-alive не нужен
+    if not WEBHOOK_URL:
+        server_thread = threading.Thread(target=run_server)
+        server_thread.daemon = True
+        server_thread.start()
+
+        keep_alive_thread = threading.Thread(target=keep_alive)
+        keep_alive_thread.daemon = True
+        keep_alive_thread.start()
+
+    # Запуск бота
+    logger.info("Бот запущен и готов к работе...")
+    if WEBHOOK_URL:
+        logger.info(
+            f"Режим вебхука на порту {PORT}: несколько копий бота принимают обновления, "
+            "только если у каждой свой PORT, а Telegram обращается к прокси перед ними"
+        )
+        run_webhook()
+    else:
+        run_polling()
 
-# Запуск бота
 if __name__ == '__main__':
-    logger.info("Бот запущен и готов к работе...")
-    bot.infinity_polling()
+    main()
@@ -0,0 +1,200 @@
+"""Минимальные метрики в текстовом формате Prometheus.
+
+Метрики объявляются на уровне модуля там, где они измеряются:
+
+    SCRAPE_ERRORS = metrics.counter('car_bot_scrape_errors_total', 'Ошибки парсинга', ('source',))
+    SCRAPE_ERRORS.inc(source='antiqcar')
+
+и отдаются все сразу через render() на /metrics.
+"""
+import bisect
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """Список (суффикс имени, значения меток, доп. метка, значение)"""
+        with self._lock:
+            return [('', key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Значение, которое задается явно через set() или вычисляется функцией при выдаче.
+
+    Функция возвращает число или словарь {значения меток (кортеж): число}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        value = self.func()
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [('', key if isinstance(key, tuple) else (key,), None, v) for key, v in value.items()]
+        return [('', (), None, value)]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер, измеряющий длительность блока"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append(('_bucket', key, f'le="{_format_value(float(bound))}"', cumulative))
+                result.append(('_bucket', key, 'le="+Inf"', count))
+                result.append(('_sum', key, None, total))
+                result.append(('_count', key, None, count))
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # Повторное объявление (например, при перезагрузке модуля) возвращает существующую метрику
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=(), func=None):
+    return REGISTRY.register(Gauge(name, documentation, labels, func=func))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+def render():
+    return REGISTRY.render()
+
+
+def timed(histogram, **labels):
+    """Декоратор: записывает длительность вызова функции в histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,564 @@
+import functools
+import importlib.util
+import logging
+import re
+import time
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+import metrics
+import profiling
+from breaker import CircuitBreaker
+from catalog import Listing, listing_key
+from crawler import Crawler
+from http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+# lxml заметно быстрее встроенного html.parser, но остается необязательным
+PARSER_BACKEND = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+
+@functools.lru_cache(maxsize=None)
+def _bs4():
+    # bs4 и lxml загружаются при первом разборе, а не при импорте модуля
+    import bs4
+    return bs4
+
+
+def _has_card_class(value):
+    # Во время разбора class приходит строкой, а не списком классов
+    if not value:
+        return False
+    classes = value.split() if isinstance(value, str) else value
+    return 'flex-item' in classes
+
+
+@functools.lru_cache(maxsize=None)
+def card_strainer():
+    """Строим дерево только из карточек автомобилей, остальная страница пропускается"""
+    return _bs4().SoupStrainer('div', attrs={'class': _has_card_class})
+
+BRAND_FROM_NAME_RE = re.compile(r'^([A-Za-zА-Яа-я]+(?:[\s\-][A-Za-zА-Яа-я]+)*)')
+WHITESPACE_RE = re.compile(r'\s+')
+PRICE_RE = re.compile(r'(\d[\d\s\u00a0\u202f]*(?:[.,]\d+)*)\s*(млн)?', re.I)
+# Год, отмеченный явно: "BMW 2002 (1972)", "ГАЗ 21 1960 г."
+EXPLICIT_YEAR_RE = re.compile(r'\((19\d{2}|20\d{2})\)|(?<!\d)(19\d{2}|20\d{2})\s*г(?:\.|ода?)?(?!\w)', re.I)
+# Год в конце названия: "Cadillac Cabriolet 1966"
+TRAILING_YEAR_RE = re.compile(r'^(.*?)(?<!\d)(19\d{2}|20\d{2})\W*$')
+
+# Признаки валюты в тексте цены; без признака цена считается в рублях
+CURRENCY_MARKERS = (('₽', 'RUB'), ('руб', 'RUB'), ('$', 'USD'), ('usd', 'USD'), ('€', 'EUR'), ('eur', 'EUR'))
+
+SCRAPE_DURATION = metrics.histogram('car_bot_scrape_duration_seconds', 'Время загрузки и разбора каталога источника', ('source',))
+SCRAPE_CARDS = metrics.gauge('car_bot_scrape_cards', 'Объявлений в последнем парсинге источника', ('source',))
+SCRAPE_PAGES = metrics.counter('car_bot_scrape_pages_total', 'Загруженные страницы источника', ('source',))
+SCRAPE_ERRORS = metrics.counter('car_bot_scrape_errors_total', 'Неудачные парсинги источника', ('source', 'reason'))
+CARD_PARSE_FAILURES = metrics.counter('car_bot_card_parse_failures_total', 'Карточки, которые не удалось разобрать', ('source',))
+PAGE_CACHE = metrics.counter('car_bot_page_cache_total', 'Повторное использование разбора неизменившихся страниц', ('result',))
+SOURCE_SKIPPED = metrics.counter('car_bot_source_skipped_total', 'Пропуски обхода источника из-за разомкнутого предохранителя', ('source',))
+
+SOLD_MARKER = "продано"
+CHILDREN_BRAND = "Авто для детей"
+
+
+class Rule:
+    """Декларативное описание тега внутри карточки.
+
+    names - допустимые имена тегов, classes - обязательные классы,
+    attrs - обязательные атрибуты (None - достаточно наличия, строка - точное значение),
+    contains - подстроки, которые должны входить в значение атрибута,
+    inside - правило для одного из предков тега.
+    """
+
+    def __init__(self, names, classes=(), attrs=None, contains=None, inside=None):
+        self.names = (names,) if isinstance(names, str) else tuple(names)
+        self.classes = tuple(classes)
+        self.attrs = attrs or {}
+        self.contains = contains or {}
+        self.inside = inside
+
+    def matches_tag(self, tag):
+        if tag.name not in self.names:
+            return False
+        if self.classes:
+            tag_classes = tag.get('class') or ()
+            for cls in self.classes:
+                if cls not in tag_classes:
+                    return False
+        for attr, value in self.attrs.items():
+            actual = tag.get(attr)
+            if actual is None or (value is not None and actual != value):
+                return False
+        for attr, part in self.contains.items():
+            actual = tag.get(attr)
+            if actual is None or part not in actual:
+                return False
+        return True
+
+    def matches(self, tag, card):
+        if not self.matches_tag(tag):
+            return False
+        if self.inside is None:
+            return True
+        parent = tag.parent
+        while parent is not None:
+            if self.inside.matches_tag(parent):
+                return True
+            if parent is card:
+                break
+            parent = parent.parent
+        return False
+
+
+# Поля карточки, общие для сайтов на одном движке
+RIGHT_COLUMN = Rule('div', classes=('right2',))
+
+DEFAULT_CARD_FIELDS = {
+    'children': Rule('span', attrs={'data-brand': CHILDREN_BRAND}),
+    'brand': Rule('span', attrs={'data-brand': None}),
+    'name': Rule(('strong', 'b'), inside=Rule('h2', classes=('left',))),
+    'photo': Rule('img', classes=('lazyload',), attrs={'data-src': None}),
+    'price': Rule('strong', inside=RIGHT_COLUMN),
+    'link': Rule('a', attrs={'href': None}),
+    'location': Rule('span', contains={'style': 'font-size:8pt'}, inside=RIGHT_COLUMN),
+}
+
+
+def page_url(url, param, number):
+    """Адрес страницы number: url с параметром запроса param=number"""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != param]
+    query.append((param, str(number)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class PageParam:
+    """Пагинация параметром запроса: market?page=2, market?page=3...
+
+    Номера страниц берутся из ссылок пагинации на загруженной странице,
+    поэтому все видимые страницы ставятся в очередь сразу, а не по одной.
+    Учитываются только ссылки на тот же адрес, что и у загруженной страницы:
+    /news?page=7 на странице каталога - не его страница.
+    """
+
+    HREF_RE = re.compile(r'''href=["']([^"']*)["']''')
+
+    def __init__(self, param='page', max_pages=20):
+        self.param = param
+        self.max_pages = max_pages
+
+    def links(self, html, url):
+        base = urlsplit(url)
+        numbers = set()
+        for match in self.HREF_RE.finditer(html):
+            link = urlsplit(urljoin(url, match.group(1).replace('&amp;', '&')))
+            if (link.netloc, link.path.rstrip('/')) != (base.netloc, base.path.rstrip('/')):
+                continue
+            value = dict(parse_qsl(link.query)).get(self.param, '')
+            if value.isdigit():
+                numbers.add(int(value))
+        return [page_url(url, self.param, number) for number in sorted(numbers) if 1 < number <= self.max_pages]
+
+
+class SourceSpec:
+    """Описание источника объявлений.
+
+    start_urls - страницы, с которых начинается обход (по умолчанию url),
+    pagination - правило с методом links(html, url), возвращающим адреса других страниц,
+    extractor(html, spec, base_url) - функция разбора страницы (по умолчанию extract_cars).
+    """
+
+    def __init__(self, name, url, category, fields=None, deadline=20, start_urls=None, pagination=None, extractor=None):
+        self.name = name
+        self.url = url
+        self.category = category
+        self.fields = fields or DEFAULT_CARD_FIELDS
+        self.deadline = deadline
+        self._start_urls = start_urls
+        self.pagination = pagination
+        self.extractor = extractor
+
+    @property
+    def start_urls(self):
+        return self._start_urls or [self.url]
+
+
+# Реестр источников; новый дилер добавляется вызовом register_source
+SOURCES = []
+
+
+def register_source(spec):
+    if any(source.name == spec.name for source in SOURCES):
+        raise ValueError(f"Источник {spec.name} уже зарегистрирован")
+    SOURCES.append(spec)
+    return spec
+
+
+ANTIQCAR = register_source(SourceSpec('antiqcar', 'https://antiqcar.ru/market', category='retro', pagination=PageParam()))
+ANTARMOTORS = register_source(SourceSpec('antarmotors', 'https://antarmotors.ru/market', category='new', pagination=PageParam()))
+
+
+def parse_price(text):
+    """Числовая цена и валюта из текста вида "12 500 000 ₽"; (None, None), если цены нет"""
+    match = PRICE_RE.search(text)
+    if match is None:
+        return None, None
+
+    number = re.sub(r'[\s\u00a0\u202f]', '', match.group(1))
+    if not match.group(2):
+        # "120,000" и "1.200.000" - разделители тысяч, а не дробная часть
+        number = re.sub(r'[.,](?=\d{3}(?!\d))', '', number)
+    number = number.replace(',', '.')
+    value = float(number)
+    if match.group(2):
+        value *= 1000000
+    if value <= 0:
+        return None, None
+
+    lowered = text.lower()
+    currency = next((code for marker, code in CURRENCY_MARKERS if marker in lowered), 'RUB')
+    return int(value), currency
+
+
+def parse_year(text):
+    """Год выпуска из названия автомобиля или None.
+
+    Берется год в скобках или с "г.", иначе число в конце названия, если перед ним
+    хотя бы два слова: в "BMW 2002" и "Ferrari 2024" это может быть номер модели.
+    """
+    matches = EXPLICIT_YEAR_RE.findall(text)
+    if matches:
+        year = int(''.join(matches[-1]))
+    else:
+        match = TRAILING_YEAR_RE.match(text)
+        if match is None or len(match.group(1).split()) < 2:
+            return None
+        year = int(match.group(2))
+    return year if year <= time.localtime().tm_year + 1 else None
+
+
+def _walk_card(card, fields):
+    """Один проход по карточке: находит первый тег для каждого поля и признак продажи.
+
+    Возвращает (found, sold), где found - словарь поле -> тег.
+    """
+    bs4 = _bs4()
+    found = {}
+    pending = list(fields.items())
+
+    for node in card.descendants:
+        if isinstance(node, bs4.Tag):
+            for value in node.attrs.values():
+                if isinstance(value, str) and SOLD_MARKER in value.lower():
+                    return found, True
+
+            if pending:
+                for field, rule in pending:
+                    if rule.matches(node, card):
+                        found[field] = node
+                pending = [(field, rule) for field, rule in pending if field not in found]
+        elif isinstance(node, bs4.NavigableString):
+            if SOLD_MARKER in node.lower():
+                return found, True
+
+    return found, False
+
+
+def _is_card(tag):
+    classes = tag.get('class') or ()
+    return tag.name == 'div' and 'flex-item' in classes and 'mix' in classes
+
+
+def extract_card(card, spec, base_url=None):
+    """Извлекает объявление из карточки или возвращает None, если она не подходит"""
+    base_url = base_url or spec.url
+
+    # Проверяем, не продан ли автомобиль
+    item_classes = ' '.join(card.get('class', [])).lower()
+    if 'sold' in item_classes or 'onsale' not in item_classes:
+        return None
+
+    for value in card.attrs.values():
+        if isinstance(value, str) and SOLD_MARKER in value.lower():
+            return None
+
+    found, sold = _walk_card(card, spec.fields)
+    if sold:
+        return None
+
+    name = "Неизвестный автомобиль"
+    name_tag = found.get('name')
+    if name_tag is not None:
+        name = name_tag.get_text().strip()
+
+    # Бренд берем из data-brand, иначе пытаемся извлечь из названия
+    brand_value = "Неизвестно"
+    brand_span = found.get('brand')
+    if brand_span is not None:
+        brand_value = brand_span.get('data-brand', 'Неизвестно')
+    elif name_tag is not None:
+        brand_match = BRAND_FROM_NAME_RE.search(name)
+        if brand_match:
+            brand_value = brand_match.group(1).strip()
+
+    if name == "Неизвестный автомобиль" or brand_value == "Неизвестно" or not brand_value:
+        return None
+
+    photo_url = None
+    photo_tag = found.get('photo')
+    if photo_tag is not None:
+        photo_url = photo_tag.get('data-src')
+        if photo_url and not photo_url.startswith('http'):
+            photo_url = urljoin(base_url, photo_url)
+        photo_url = photo_url.strip()
+
+    price = "Цена по запросу"
+    price_tag = found.get('price')
+    if price_tag is not None:
+        price = WHITESPACE_RE.sub(' ', price_tag.get_text()).strip()
+
+    link = ""
+    link_tag = found.get('link')
+    if link_tag is not None:
+        link = link_tag['href']
+        if link and not link.startswith('http'):
+            link = urljoin(base_url, link)
+
+    # Берем текст о наличии целиком, например "В наличии в Москве"
+    location = "Город не указан"
+    location_tag = found.get('location')
+    if location_tag is not None:
+        location = location_tag.get_text().strip()
+
+    category = 'children' if 'children' in found else spec.category
+
+    price_value, currency = parse_price(price)
+    year = parse_year(name)
+
+    # Строки приводятся к str, чтобы объявление не держало ссылки на дерево разбора
+    return Listing(
+        name=str(name),
+        brand=brand_value,
+        price=price,
+        photo=str(photo_url) if photo_url is not None else None,
+        link=str(link),
+        location=location,
+        year=str(year) if year else "Год не указан",
+        year_value=year,
+        price_value=price_value,
+        currency=currency,
+        source=spec.name,
+        category=category,
+    )
+
+
+def extract_cars(html, spec, base_url=None):
+    """Разбирает страницу каталога источника и возвращает список объявлений"""
+    soup = _bs4().BeautifulSoup(html, PARSER_BACKEND, parse_only=card_strainer())
+
+    cars = []
+    for item in soup.find_all(_is_card):
+        try:
+            car = extract_card(item, spec, base_url)
+            if car is not None:
+                cars.append(car)
+        except Exception as e:
+            CARD_PARSE_FAILURES.inc(source=spec.name)
+            logger.error(f"Ошибка при обработке карточки {spec.name}: {e}")
+            continue
+
+    # Дерево страницы больше не нужно: освобождаем его сразу, не дожидаясь сборщика циклов
+    soup.decompose()
+    return cars
+
+
+# Общий HTTP-клиент с постоянными соединениями к сайтам
+http_client = HttpClient(timeout=15)
+
+# Планировщик обхода с ограничением частоты запросов к каждому сайту
+page_crawler = Crawler()
+
+# Результаты разбора страниц по хешу содержимого: url -> (hash, cars, links)
+parsed_pages = {}
+
+# Предохранители источников: name -> CircuitBreaker
+breakers = {}
+breaker_settings = {}
+
+# Последние удачные объявления источников: name -> (cars, fetched_at)
+last_good = {}
+
+# Источники, которые сейчас отдаются из last_good: name -> fetched_at
+stale_sources = {}
+
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+def configure_breakers(**settings):
+    """Задает параметры CircuitBreaker для всех источников"""
+    breaker_settings.update(settings)
+    breakers.clear()
+
+
+def breaker_for(spec):
+    breaker = breakers.get(spec.name)
+    if breaker is None:
+        breaker = breakers[spec.name] = CircuitBreaker(spec.name, **breaker_settings)
+    return breaker
+
+
+def remember_cars(cars, fetched_at):
+    """Запоминает объявления восстановленного снимка как последние удачные для их источников"""
+    by_source = {}
+    for car in cars:
+        car = car.replace(stale=False)
+        by_source.setdefault(car['source'], []).append(car)
+    for name, source_cars in by_source.items():
+        last_good.setdefault(name, (source_cars, fetched_at))
+
+
+def source_status():
+    """Состояние источников для /health: предохранитель и возраст отдаваемых данных"""
+    status = {}
+    for spec in SOURCES:
+        cars, fetched_at = last_good.get(spec.name, ((), None))
+        status[spec.name] = {
+            **breaker_for(spec).to_dict(),
+            'stale': spec.name in stale_sources,
+            'last_success': fetched_at,
+            'cars': len(cars),
+        }
+    return status
+
+
+metrics.gauge(
+    'car_bot_source_breaker_state', 'Состояние предохранителя источника: 0 - замкнут, 1 - проба, 2 - разомкнут', ('source',),
+    func=lambda: {(name,): BREAKER_STATE_VALUES[breaker.state] for name, breaker in list(breakers.items())}
+)
+
+
+def fetch_page(spec, url):
+    """Загружает и разбирает одну страницу источника, возвращает (cars, links)"""
+    SCRAPE_PAGES.inc(source=spec.name)
+    with profiling.span('page', source=spec.name):
+        with profiling.span('http'):
+            page = http_client.fetch(url)
+
+        # Страница не изменилась (304 или тот же хеш) - используем прошлый разбор
+        cached = parsed_pages.get(url)
+        if cached and cached[0] == page.content_hash and cached[2] is not None:
+            PAGE_CACHE.inc(result='hit')
+            return cached[1], cached[2]
+
+        PAGE_CACHE.inc(result='miss')
+
+        # 304 без сохраненного разбора - запрашиваем страницу целиком
+        if page.text is None:
+            with profiling.span('http'):
+                page = http_client.fetch(url, conditional=False)
+
+        with profiling.span('extract'):
+            extractor = spec.extractor or extract_cars
+            cars = extractor(page.text, spec, url)
+            links = spec.pagination.links(page.text, url) if spec.pagination else []
+        parsed_pages[url] = (page.content_hash, cars, links)
+        return cars, links
+
+
+def _stale(spec):
+    """Последние удачные объявления источника с пометкой stale или пустой список"""
+    if spec.name not in last_good:
+        return []
+    cars, fetched_at = last_good[spec.name]
+    stale_sources[spec.name] = fetched_at
+    return [car.replace(stale=True) for car in cars]
+
+
+def _collect(result):
+    """Объявления источника из результата обхода; при ошибке или таймауте - последние удачные"""
+    import requests
+
+    spec = result.spec
+    breaker = breaker_for(spec)
+    if result.timed_out:
+        SCRAPE_ERRORS.inc(source=spec.name, reason='timeout')
+        logger.error(f"Источник {spec.name} не уложился в срок, пропускаем")
+        breaker.record_failure("таймаут")
+        return _stale(spec)
+    if isinstance(result.error, requests.exceptions.RequestException):
+        SCRAPE_ERRORS.inc(source=spec.name, reason='network')
+        logger.error(f"Ошибка сети при парсинге {spec.name}: {result.error}")
+        breaker.record_failure(result.error)
+        return _stale(spec)
+    if result.error is not None:
+        SCRAPE_ERRORS.inc(source=spec.name, reason='parse')
+        logger.error(f"Ошибка при парсинге {spec.name}: {result.error}")
+        breaker.record_failure(result.error)
+        return _stale(spec)
+
+    # Недоступная страница пагинации не проваливает источник: берем ее прошлый разбор, если он есть
+    for url, error in result.page_errors.items():
+        SCRAPE_ERRORS.inc(source=spec.name, reason='page')
+        logger.warning(f"Страница {url} источника {spec.name} пропущена: {error}")
+        cached = parsed_pages.get(url)
+        if cached is not None:
+            result.pages[url] = [car.replace(stale=True) for car in cached[1]]
+
+    # Объявление могло сдвинуться на соседнюю страницу во время обхода
+    cars = []
+    seen = set()
+    for car in result.cars():
+        key = listing_key(car)
+        if key not in seen:
+            seen.add(key)
+            cars.append(car)
+
+    SCRAPE_DURATION.observe(result.elapsed, source=spec.name)
+    SCRAPE_CARDS.set(len(cars), source=spec.name)
+    breaker.record_success()
+    last_good[spec.name] = (cars, time.time())
+    stale_sources.pop(spec.name, None)
+    return cars
+
+
+def parse_source(spec):
+    """Загружает и разбирает все страницы одного источника"""
+    return parse_all_cars([spec])
+
+
+# Функция для парсинга сайта antiqcar.ru
+def parse_antiqcar():
+    return parse_source(ANTIQCAR)
+
+
+# Функция для парсинга сайта antarmotors.ru
+def parse_antarmotors():
+    return parse_source(ANTARMOTORS)
+
+
+# Основная функция для парсинга всех сайтов
+def parse_all_cars(sources=None, deadline=None, crawler=None):
+    """Обходит все источники параллельно.
+
+    deadline переопределяет крайний срок ожидания каждого источника.
+    Медленный или недоступный сайт не задерживает остальные: после нескольких
+    неудач подряд его предохранитель размыкается, сайт не опрашивается
+    до следующей пробы, а вместо его объявлений отдаются последние удачные
+    с пометкой stale.
+    """
+    sources = SOURCES if sources is None else sources
+    with profiling.span('scrape'):
+        allowed = [spec for spec in sources if breaker_for(spec).allow()]
+        # Страницы загружаются в потоках обходчика, их этапы - отдельные интервалы page
+        with profiling.span('crawl'):
+            results = (crawler or page_crawler).crawl(allowed, fetch_page, deadline=deadline)
+
+        cars = []
+        with profiling.span('collect'):
+            for spec in sources:
+                if spec.name in results:
+                    cars.extend(_collect(results[spec.name]))
+                else:
+                    SOURCE_SKIPPED.inc(source=spec.name)
+                    cars.extend(_stale(spec))
+        return cars
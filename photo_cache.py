@@ -0,0 +1,253 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram не скачивает по ссылке фото больше 5 МБ
+MAX_PHOTO_SIZE = 5 * 1024 * 1024
+
+PHOTO_CACHE_LOOKUPS = metrics.counter('car_bot_photo_cache_lookups_total', 'Поиск file_id фото в кэше', ('result',))
+
+
+class PhotoCache:
+    """Постоянный кэш фото: url -> file_id Telegram, версия фото и признак битой ссылки.
+
+    Хранится в SQLite, которую делят все процессы бота на хосте: каждое изменение
+    сразу пишется в свою строку, так что процессы не затирают записи друг друга.
+    Для чтения держится копия в памяти; reload() подхватывает изменения других
+    процессов, например битые ссылки, найденные проверкой фото у лидера.
+
+    Версия (поле hash) собирается из ETag, Last-Modified и размера, которые вернул сайт;
+    если она изменилась, картинка по тому же адресу другая и file_id сбрасывается.
+
+    Формат записи в памяти: {'file_id': str|None, 'hash': str|None, 'dead': bool, 'checked_at': float|None}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS photos ("
+                    "url TEXT PRIMARY KEY, file_id TEXT, hash TEXT, "
+                    "dead INTEGER NOT NULL DEFAULT 0, checked_at REAL)"
+                )
+                # Прежние хеши содержимого не сравнимы с версией по заголовкам: без этого
+                # первая проверка сбросила бы file_id всех уже загруженных фото
+                conn.execute("UPDATE photos SET hash = NULL WHERE hash NOT LIKE '%|%'")
+        finally:
+            conn.close()
+        self.reload()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, sql, params):
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить кэш фото {self.path}: {e}")
+
+    def reload(self, snapshot=None):
+        """Перечитывает кэш из базы; подходит как обработчик обновления каталога"""
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT url, file_id, hash, dead, checked_at FROM photos").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось загрузить кэш фото {self.path}: {e}")
+            return
+
+        entries = {
+            url: {'file_id': file_id, 'hash': content_hash, 'dead': bool(dead), 'checked_at': checked_at}
+            for url, file_id, content_hash, dead, checked_at in rows
+        }
+        with self._lock:
+            self._entries = entries
+
+    def _entry(self, url):
+        # Вызывается под self._lock
+        entry = self._entries.get(url)
+        if entry is None:
+            entry = self._entries[url] = {'file_id': None, 'hash': None, 'dead': False, 'checked_at': None}
+        return entry
+
+    def file_id(self, url):
+        entry = self._entries.get(url)
+        if entry and entry.get('file_id'):
+            PHOTO_CACHE_LOOKUPS.inc(result='hit')
+            return entry['file_id']
+        PHOTO_CACHE_LOOKUPS.inc(result='miss')
+        return None
+
+    def is_dead(self, url):
+        entry = self._entries.get(url)
+        return bool(entry and entry.get('dead'))
+
+    def remember(self, url, file_id):
+        """Запоминает file_id после первой успешной загрузки фото"""
+        with self._lock:
+            entry = self._entry(url)
+            entry['file_id'] = file_id
+            entry['dead'] = False
+        self._execute(
+            "INSERT INTO photos (url, file_id, dead) VALUES (?, ?, 0) "
+            "ON CONFLICT (url) DO UPDATE SET file_id = excluded.file_id, dead = 0",
+            (url, file_id)
+        )
+
+    def mark_checked(self, url, content_hash, dead=False):
+        """Запоминает итог проверки; content_hash=None - сайт не сообщил версию, прежняя сохраняется"""
+        with self._lock:
+            entry = self._entry(url)
+            if content_hash is not None:
+                # Картинка по тому же адресу сменилась - старый file_id больше не подходит
+                if entry['hash'] and entry['hash'] != content_hash:
+                    entry['file_id'] = None
+                entry['hash'] = content_hash
+            entry['dead'] = dead
+            entry['checked_at'] = time.time()
+            checked_at = entry['checked_at']
+        self._execute(
+            "INSERT INTO photos (url, hash, dead, checked_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET "
+            "file_id = CASE WHEN excluded.hash IS NOT NULL AND photos.hash IS NOT NULL "
+            "AND photos.hash IS NOT excluded.hash THEN NULL ELSE photos.file_id END, "
+            "hash = COALESCE(excluded.hash, photos.hash), dead = excluded.dead, checked_at = excluded.checked_at",
+            (url, content_hash, int(dead), checked_at)
+        )
+
+    def forget_file_id(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry or not entry.get('file_id'):
+                return
+            entry['file_id'] = None
+        self._execute("UPDATE photos SET file_id = NULL WHERE url = ?", (url,))
+
+    def needs_check(self, url, max_age):
+        entry = self._entries.get(url)
+        if entry is None or entry.get('checked_at') is None:
+            return True
+        return time.time() - entry['checked_at'] > max_age
+
+
+def photo_size(response):
+    """Полный размер фото по заголовкам ответа или None, если сайт его не сообщил"""
+    if response.status_code == 206:
+        # Content-Range: bytes 0-0/123456
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    else:
+        total = response.headers.get('Content-Length', '')
+    return int(total) if total.isdigit() else None
+
+
+def photo_version(response, size):
+    """Версия фото из ETag, Last-Modified и размера; None, если сайт не сообщил ничего из этого"""
+    parts = (response.headers.get('ETag'), response.headers.get('Last-Modified'), size)
+    if all(part is None for part in parts):
+        return None
+    return '|'.join('' if part is None else str(part) for part in parts)
+
+
+class PhotoPrefetcher:
+    """Проверяет новые ссылки на фото сразу после парсинга каталога.
+
+    Битые ссылки помечаются в кэше, и карточки с ними сразу отправляются текстом.
+    Если передан crawler, проверки идут в его лимитах хоста наравне с обходом страниц.
+    """
+
+    def __init__(self, cache, http_client, workers=4, recheck_after=7 * 24 * 3600, timeout=15, crawler=None):
+        self.cache = cache
+        self.http_client = http_client
+        self.crawler = crawler
+        self.recheck_after = recheck_after
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photo-check')
+        self._in_progress = set()
+        self._lock = threading.Lock()
+
+    def check(self, url):
+        """Проверяет ссылку без скачивания фото и возвращает (version, dead) или None, если сайт сейчас не ответил.
+
+        Запрашивается только первый байт, размер берется из Content-Range или Content-Length;
+        тело ответа не читается, даже если сайт не поддерживает Range. Битой ссылка считается
+        только по окончательному ответу: 404/410, не картинка, пустой файл или больше
+        MAX_PHOTO_SIZE. Таймауты, 429 и 5xx проверяются заново после следующего парсинга.
+        """
+        import requests
+
+        try:
+            session = self.http_client.session(url)
+            with self.crawler.slot(url) if self.crawler is not None else nullcontext():
+                with session.get(url, timeout=self.timeout, stream=True, headers={'Range': 'bytes=0-0'}) as response:
+                    status = response.status_code
+                    if status in (404, 410):
+                        return None, True
+                    # 416 - в файле нет даже первого байта
+                    if status == 416:
+                        return None, True
+                    if status not in (200, 206):
+                        logger.warning(f"Фото временно недоступно {url}: HTTP {status}")
+                        return None
+
+                    if not response.headers.get('Content-Type', '').startswith('image/'):
+                        return None, True
+
+                    size = photo_size(response)
+                    if size is not None and (size == 0 or size > MAX_PHOTO_SIZE):
+                        return None, True
+                    return photo_version(response, size), False
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Фото временно недоступно {url}: {e}")
+            return None
+
+    def _check_and_store(self, url):
+        try:
+            result = self.check(url)
+            if result is not None:
+                content_hash, dead = result
+                self.cache.mark_checked(url, content_hash, dead=dead)
+        except Exception as e:
+            logger.error(f"Ошибка проверки фото {url}: {e}")
+        finally:
+            with self._lock:
+                self._in_progress.discard(url)
+
+    def prefetch(self, snapshot):
+        """Обработчик обновления каталога: ставит в очередь непроверенные фото"""
+        queued = 0
+        for car in snapshot.cars:
+            url = car.get('photo')
+            if not url or not self.cache.needs_check(url, self.recheck_after):
+                continue
+            with self._lock:
+                if url in self._in_progress:
+                    continue
+                self._in_progress.add(url)
+            self._executor.submit(self._check_and_store, url)
+            queued += 1
+        if queued:
+            logger.info(f"Проверка фото: в очереди {queued} новых ссылок")
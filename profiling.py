@@ -0,0 +1,132 @@
+"""Необязательное профилирование: интервалы этапов и сэмплирующий профилировщик.
+
+Интервалы (span) размечают этапы обработки:
+
+    with profiling.span('telegram', method='sendMessage'):
+        ...
+
+Пока профилирование не включено через configure(True), span ничего
+не делает. Во включенном режиме длительность каждого интервала пишется
+в car_bot_span_seconds, а корневой интервал потока дольше slow_threshold
+попадает в лог вместе с разбивкой по вложенным этапам.
+
+sample(seconds) снимает стеки всех потоков и возвращает их в свернутом формате
+(folded stacks), который принимают flamegraph.pl и speedscope.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPAN_DURATION = metrics.histogram('car_bot_span_seconds', 'Длительность этапов обработки', ('span',))
+
+enabled = False
+slow_threshold = 1.0
+
+_local = threading.local()
+_sampling = threading.Lock()
+
+
+def configure(enable, threshold=1.0):
+    """Включает или выключает интервалы и задает порог медленного запроса в секундах"""
+    global enabled, slow_threshold
+    enabled = enable
+    slow_threshold = threshold
+
+
+class _Span:
+    def __init__(self, name, labels):
+        self.name = name + ''.join(f":{value}" for value in labels.values())
+        self.children = []
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        _local.stack.pop()
+        SPAN_DURATION.observe(self.elapsed, span=self.name)
+        if self.parent is not None:
+            self.parent.children.append(self)
+        elif self.elapsed >= slow_threshold:
+            logger.warning(f"Медленный запрос {self.name}: {self.elapsed:.2f} с ({self.breakdown()})")
+        return False
+
+    def breakdown(self):
+        """Суммарное время вложенных этапов по именам, от самых долгих"""
+        totals = {}
+        pending = list(self.children)
+        while pending:
+            child = pending.pop()
+            total, count = totals.get(child.name, (0.0, 0))
+            totals[child.name] = (total + child.elapsed, count + 1)
+            pending.extend(child.children)
+        if not totals:
+            return "без вложенных этапов"
+        ranked = sorted(totals.items(), key=lambda item: -item[1][0])
+        return ', '.join(f"{name} {total:.2f} с ×{count}" for name, (total, count) in ranked)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **labels):
+    """Интервал этапа; значения меток добавляются к имени: span('telegram', method='getMe') -> telegram:getMe"""
+    if not enabled:
+        return _NO_SPAN
+    return _Span(name, labels)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def sample(seconds, interval=0.005):
+    """Снимает стеки всех потоков каждые interval секунд в течение seconds.
+
+    Возвращает текст в формате folded stacks: "поток;файл:функция;... число".
+    Одновременно работает только один профилировщик; если он уже запущен - None.
+    """
+    if not _sampling.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _sampling.release()
+
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Сколько секунд ждать до появления токена"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def try_consume(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def consume(self):
+        """Блокирует поток до получения токена"""
+        while not self.try_consume():
+            time.sleep(self.delay())
+
+    def pause(self, seconds):
+        """Опустошает ведро так, чтобы следующий токен появился через seconds"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate + 1)
@@ -0,0 +1,44 @@
+import threading
+
+import metrics
+import profiling
+
+RENDER_CACHE = metrics.counter('car_bot_render_cache_total', 'Готовые тексты и клавиатуры из кэша', ('result',))
+
+
+class RenderCache:
+    """Кэш готовых текстов, подписей и сериализованных клавиатур.
+
+    Записи действительны для одного содержимого каталога: когда меняется
+    content_hash снимка, кэш очищается целиком. Число записей ограничено
+    max_entries, сверх него результат строится, но не сохраняется.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._content_hash = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, content_hash, key, build):
+        """Значение для key из кэша или результат build(), который запоминается"""
+        with self._lock:
+            if content_hash != self._content_hash:
+                self._content_hash = content_hash
+                self._entries = {}
+            value = self._entries.get(key)
+        if value is not None:
+            RENDER_CACHE.inc(result='hit')
+            return value
+
+        RENDER_CACHE.inc(result='miss')
+        # Строим вне блокировки: повторная сборка одной записи безвредна
+        with profiling.span('render', kind=key[0] if isinstance(key, tuple) else key):
+            value = build()
+        with self._lock:
+            if content_hash == self._content_hash and len(self._entries) < self.max_entries:
+                self._entries[key] = value
+        return value
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,140 @@
+"""Полнотекстовый поиск по объявлениям снимка для inline-режима.
+
+Текст приводится к латинице (транслитерация кириллицы) и упрощенному
+написанию, поэтому запросы "мерседес" и "mercedes" находят одни и те же
+объявления. Слова запроса ищутся по префиксу в отсортированном словаре,
+а если префикс ничего не дал - по похожим словам через индекс триграмм,
+что прощает опечатки.
+"""
+import bisect
+import functools
+import re
+
+TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya',
+})
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+# Упрощение латинского написания, чтобы транслитерация совпадала с оригиналом:
+# cadillac и кадиллак -> kadilak, lexus и лексус -> leksus
+FOLDS = tuple((re.compile(pattern), replacement) for pattern, replacement in (
+    (r'ph', 'f'),
+    (r'gh', 'g'),
+    (r'ck', 'k'),
+    (r'c(?=[eiy])', 's'),
+    (r'c', 'k'),
+    (r'x', 'ks'),
+    (r'w', 'v'),
+    (r'q', 'k'),
+    (r'([a-z])\1', r'\1'),
+))
+
+# Поля объявления, по которым идет поиск
+SEARCH_FIELDS = ('brand', 'name', 'location')
+
+# Минимальная доля общих триграмм, при которой слово считается похожим
+FUZZY_THRESHOLD = 0.35
+
+# Сколько похожих слов учитывать для одного слова запроса
+FUZZY_CANDIDATES = 5
+
+
+@functools.lru_cache(maxsize=65536)
+def fold(word):
+    for pattern, replacement in FOLDS:
+        word = pattern.sub(replacement, word)
+    return word
+
+
+def normalize(text):
+    """Слова текста в нижнем регистре латиницей в упрощенном написании"""
+    return [fold(word) for word in WORD_RE.findall(text.lower().translate(TRANSLIT))]
+
+
+def trigrams(word):
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """Индекс слов объявлений: отсортированный словарь для префиксов и триграммы для опечаток"""
+
+    def __init__(self, cars):
+        self.cars = cars
+
+        postings = {}
+        for doc, car in enumerate(cars):
+            for field in SEARCH_FIELDS:
+                for word in normalize(car.get(field) or ''):
+                    postings.setdefault(word, set()).add(doc)
+
+        self.words = sorted(postings)
+        self.postings = [postings[word] for word in self.words]
+
+        self.trigrams = {}
+        for position, word in enumerate(self.words):
+            for gram in trigrams(word):
+                self.trigrams.setdefault(gram, []).append(position)
+
+    def _prefix(self, word):
+        """Позиции слов словаря, начинающихся с word"""
+        start = bisect.bisect_left(self.words, word)
+        end = start
+        while end < len(self.words) and self.words[end].startswith(word):
+            end += 1
+        return range(start, end)
+
+    def _fuzzy(self, word):
+        """Позиции похожих слов по доле общих триграмм"""
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for position in self.trigrams.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+
+        scored = []
+        for position, count in shared.items():
+            similarity = count / len(grams | trigrams(self.words[position]))
+            if similarity >= FUZZY_THRESHOLD:
+                scored.append((similarity, position))
+        scored.sort(reverse=True)
+        return [position for _, position in scored[:FUZZY_CANDIDATES]]
+
+    def _match(self, word):
+        """Документы, подходящие под слово запроса, с весом совпадения"""
+        matched = {}
+        for position in self._prefix(word):
+            # Точное совпадение слова ценнее совпадения по префиксу
+            weight = 3 if self.words[position] == word else 2
+            for doc in self.postings[position]:
+                matched[doc] = max(matched.get(doc, 0), weight)
+
+        if not matched and len(word) >= 3:
+            for position in self._fuzzy(word):
+                for doc in self.postings[position]:
+                    matched.setdefault(doc, 1)
+        return matched
+
+    def search(self, query):
+        """Объявления, в которых найдены все слова запроса, от лучших совпадений к худшим"""
+        words = normalize(query)
+        if not words:
+            return []
+
+        scores = None
+        for word in words:
+            matched = self._match(word)
+            if scores is None:
+                scores = matched
+            else:
+                scores = {doc: score + matched[doc] for doc, score in scores.items() if doc in matched}
+            if not scores:
+                return []
+
+        ranked = sorted(scores, key=lambda doc: (-scores[doc], doc))
+        return [self.cars[doc] for doc in ranked]
@@ -0,0 +1,352 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import metrics
+import profiling
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_DURATION = metrics.histogram('car_bot_telegram_api_duration_seconds', 'Время вызова Telegram Bot API', ('method',))
+TELEGRAM_API_ERRORS = metrics.counter('car_bot_telegram_api_errors_total', 'Ошибки вызовов Telegram Bot API', ('method', 'code'))
+TELEGRAM_RATE_LIMITED = metrics.counter('car_bot_telegram_rate_limited_total', 'Ответы 429 от Telegram Bot API', ('method',))
+
+# Telegram принимает не больше 10 фото в одном альбоме
+MEDIA_GROUP_LIMIT = 10
+
+
+_sessions = threading.local()
+
+
+def telegram_request_sender(method, url, **kwargs):
+    """Отправитель запросов для telebot.apihelper.CUSTOM_REQUEST_SENDER с метриками по методам API"""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        import requests
+        session = _sessions.session = requests.Session()
+
+    api_method = urlsplit(url).path.rsplit('/', 1)[-1]
+    with TELEGRAM_API_DURATION.time(method=api_method), profiling.span('telegram', method=api_method):
+        response = session.request(method, url, **kwargs)
+
+    if response.status_code == 429:
+        TELEGRAM_RATE_LIMITED.inc(method=api_method)
+    if response.status_code >= 400:
+        TELEGRAM_API_ERRORS.inc(method=api_method, code=response.status_code)
+    return response
+
+
+def retry_after(error):
+    """retry_after из ответа 429 или None для прочих ошибок"""
+    from telebot.apihelper import ApiTelegramException
+
+    if not isinstance(error, ApiTelegramException) or error.error_code != 429:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+class _Job:
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+
+class SendQueue:
+    """Очередь исходящих вызовов Telegram API с учетом лимитов.
+
+    Вызовы для одного чата выполняются строго по порядку, разные чаты
+    обслуживаются параллельно. Общий лимит и лимит на чат задаются
+    ведрами токенов, ответ 429 откладывает чат на retry_after секунд.
+    """
+
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=4, max_retries=5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+
+        self._chats = {}
+        self._chat_buckets = {}
+        self._scheduled = set()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+        self.rate_limited = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id, delay=0.0):
+        # Вызывается под self._cond
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Ставит вызов в очередь чата и возвращает Future с его результатом"""
+        job = _Job(func, args, kwargs)
+        with self._cond:
+            self._chats.setdefault(chat_id, deque()).append(job)
+            if chat_id not in self._scheduled:
+                self._schedule(chat_id, self._chat_bucket(chat_id).delay())
+        return job.future
+
+    @property
+    def pending(self):
+        with self._cond:
+            return sum(len(jobs) for jobs in self._chats.values())
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                ready_at, _, chat_id = self._heap[0]
+                wait = ready_at - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+
+                # Лимит чата мог еще не восстановиться - переносим чат
+                bucket = self._chat_bucket(chat_id)
+                if not bucket.try_consume():
+                    heapq.heappush(self._heap, (time.monotonic() + bucket.delay(), next(self._seq), chat_id))
+                    continue
+
+                return chat_id, self._chats[chat_id].popleft()
+
+    def _finish(self, chat_id, job=None, delay=None):
+        with self._cond:
+            jobs = self._chats[chat_id]
+            if job is not None:
+                # Повторяем тот же вызов первым, чтобы не нарушить порядок
+                jobs.appendleft(job)
+            if jobs:
+                if delay is None:
+                    delay = self._chat_bucket(chat_id).delay()
+                heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), chat_id))
+                self._cond.notify()
+            else:
+                del self._chats[chat_id]
+                self._scheduled.discard(chat_id)
+                # Ведра простаивающих чатов не храним бесконечно
+                if len(self._chat_buckets) > self.MAX_IDLE_BUCKETS:
+                    for idle_chat in [c for c in self._chat_buckets if c not in self._chats]:
+                        del self._chat_buckets[idle_chat]
+
+    def call_with_retry(self, func, *args, **kwargs):
+        """Синхронный вызов с ожиданием retry_after, для вызовов внутри задания"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None or attempt == self.max_retries:
+                    raise
+                self.rate_limited += 1
+                time.sleep(wait)
+
+    def _run(self):
+        while True:
+            chat_id, job = self._next_job()
+            self.global_bucket.consume()
+
+            job.attempts += 1
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is not None and job.attempts <= self.max_retries:
+                    self.rate_limited += 1
+                    logger.warning(f"Telegram 429 для чата {chat_id}, повтор через {wait} с")
+                    self._chat_bucket(chat_id).pause(wait)
+                    self._finish(chat_id, job=job, delay=wait)
+                    continue
+                # Результаты большинства вызовов никто не ждет - ошибка должна попасть в лог здесь
+                logger.error(f"Ошибка отправки в чат {chat_id}: {e}")
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            self._finish(chat_id)
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'send-{i}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+class Card:
+    """Карточка автомобиля: текст и необязательное фото"""
+
+    def __init__(self, text, photo=None):
+        self.text = text
+        self.photo = photo
+
+
+PHOTO_UNAVAILABLE_PREFIX = "⚠️ Фото недоступно\n\n"
+
+
+def _photo_file_id(message):
+    # Самый крупный размер фото идет последним
+    if message is not None and getattr(message, 'photo', None):
+        return message.photo[-1].file_id
+    return None
+
+
+class TelegramSender:
+    """Отправка сообщений бота через SendQueue.
+
+    Карточки и завершающие сообщения идут через очередь. Ответы на действие
+    пользователя (reply_to, respond, правки сообщений, ответы на callback- и
+    inline-запросы) отправляются сразу из обработчика, чтобы не ждать
+    карточек других чатов, но после 429 тоже повторяются через retry_after.
+
+    Если передан photo_cache, уже загруженные фото отправляются по file_id,
+    а карточки с заведомо битыми ссылками сразу уходят текстом.
+    """
+
+    def __init__(self, bot, queue, photo_cache=None):
+        self.bot = bot
+        self.queue = queue
+        self.photo_cache = photo_cache
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.queue.submit(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def respond(self, chat_id, text, **kwargs):
+        return self.queue.call_with_retry(self.bot.send_message, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.queue.call_with_retry(self.bot.reply_to, message, text, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        from telebot.apihelper import ApiTelegramException
+
+        try:
+            return self.queue.call_with_retry(
+                self.bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, **kwargs
+            )
+        except ApiTelegramException as e:
+            # Повторное нажатие той же кнопки - сообщение уже показывает нужный текст
+            if 'message is not modified' not in str(e.description):
+                raise
+            return None
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None):
+        return self.queue.call_with_retry(
+            self.bot.edit_message_reply_markup, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+        )
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        return self.queue.call_with_retry(self.bot.answer_callback_query, callback_query_id, text)
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        return self.queue.call_with_retry(self.bot.answer_inline_query, inline_query_id, results, **kwargs)
+
+    def send_cards(self, chat_id, cards):
+        """Отправляет карточки по порядку, объединяя идущие подряд фото в альбомы"""
+        futures = []
+        batch = []
+
+        for card in cards:
+            text = card.text
+            if card.photo and self.photo_cache is not None and self.photo_cache.is_dead(card.photo):
+                text = PHOTO_UNAVAILABLE_PREFIX + text
+            elif card.photo:
+                batch.append(card)
+                if len(batch) == MEDIA_GROUP_LIMIT:
+                    futures.append(self._send_batch(chat_id, batch))
+                    batch = []
+                continue
+
+            if batch:
+                futures.append(self._send_batch(chat_id, batch))
+                batch = []
+            futures.append(self.send_message(chat_id, text, disable_web_page_preview=True))
+
+        if batch:
+            futures.append(self._send_batch(chat_id, batch))
+
+        return futures
+
+    def _send_batch(self, chat_id, batch):
+        if len(batch) == 1:
+            return self.queue.submit(chat_id, self._send_photo_card, chat_id, batch[0])
+        return self.queue.submit(chat_id, self._send_album, chat_id, list(batch))
+
+    def _media(self, card):
+        """file_id из кэша или исходная ссылка на фото"""
+        if self.photo_cache is not None:
+            return self.photo_cache.file_id(card.photo) or card.photo
+        return card.photo
+
+    def _remember(self, card, message):
+        file_id = _photo_file_id(message)
+        if self.photo_cache is not None and file_id:
+            self.photo_cache.remember(card.photo, file_id)
+
+    def _send_photo_card(self, chat_id, card):
+        media = self._media(card)
+        try:
+            message = self.bot.send_photo(chat_id, media, caption=card.text)
+            self._remember(card, message)
+            return message
+        except Exception as e:
+            if retry_after(e) is not None:
+                raise
+            logger.error(f"Ошибка отправки фото: {e}")
+            if self.photo_cache is not None and media != card.photo:
+                # Устаревший file_id - в следующий раз загрузим по ссылке
+                self.photo_cache.forget_file_id(card.photo)
+            return self.bot.send_message(
+                chat_id,
+                PHOTO_UNAVAILABLE_PREFIX + card.text,
+                disable_web_page_preview=True
+            )
+
+    def _send_album(self, chat_id, batch):
+        from telebot import types
+
+        media = [
+            types.InputMediaPhoto(self._media(card), caption=card.text, parse_mode='HTML')
+            for card in batch
+        ]
+        try:
+            messages = self.bot.send_media_group(chat_id, media)
+            for card, message in zip(batch, messages):
+                self._remember(card, message)
+            return messages
+        except Exception as e:
+            if retry_after(e) is not None:
+                raise
+            # Одно битое фото ломает весь альбом - отправляем карточки по одной
+            logger.error(f"Ошибка отправки альбома, отправляем по одной: {e}")
+            messages = []
+            for card in batch:
+                self.queue.global_bucket.consume()
+                messages.append(self.queue.call_with_retry(self._send_photo_card, chat_id, card))
+            return messages
@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import pathlib
+import pickle
+import re
+import sqlite3
+import threading
+import types
+import zlib
+
+import catalog
+import search
+from catalog import CatalogSnapshot, dump_listings, load_listings
+
+logger = logging.getLogger(__name__)
+
+# Модули, код которых определяет содержимое сохраненных индексов снимка:
+# классы снимка и объявлений, а также brand_key, транслитерация и нормализация слов поиска
+SNAPSHOT_MODULES = (catalog, search)
+
+# Константы этих типов входят в отпечаток; у прочих объектов (метрик, блокировок) repr содержит адрес
+_CONSTANT_TYPES = (str, int, float, bool, tuple, dict, frozenset, re.Pattern)
+
+
+def _fingerprint_code(code, parts):
+    parts.append(code.co_code)
+    parts.append(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _fingerprint_code(const, parts)
+        elif isinstance(const, frozenset):
+            # Порядок элементов множества зависит от PYTHONHASHSEED
+            parts.append(repr(sorted(map(repr, const))).encode('utf-8'))
+        else:
+            parts.append(repr(const).encode('utf-8'))
+
+
+def _fingerprint_function(name, member, parts):
+    # Методы класса, свойства и функции под lru_cache приводятся к исходной функции
+    func = getattr(member, '__func__', None) or getattr(member, 'fget', None) or member
+    func = getattr(func, '__wrapped__', func)
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        parts.append(f"{name}:{func.__defaults__!r}".encode('utf-8'))
+        _fingerprint_code(code, parts)
+
+
+def snapshot_format():
+    """Отпечаток кода модулей SNAPSHOT_MODULES: функций, классов с их слотами и методами и констант.
+
+    Любое изменение этого кода меняет отпечаток, и старые индексы не
+    распаковываются, а строятся заново из списка объявлений.
+    """
+    parts = []
+    for module in SNAPSHOT_MODULES:
+        for name, value in sorted(vars(module).items()):
+            if getattr(value, '__module__', module.__name__) != module.__name__:
+                # Импортированное из других модулей
+                continue
+            if isinstance(value, type):
+                parts.append(f"{module.__name__}.{name}:{getattr(value, '__slots__', None)!r}".encode('utf-8'))
+                for member_name, member in sorted(vars(value).items()):
+                    _fingerprint_function(f"{name}.{member_name}", member, parts)
+            elif callable(value):
+                _fingerprint_function(f"{module.__name__}.{name}", value, parts)
+            elif name.isupper() and isinstance(value, _CONSTANT_TYPES):
+                if isinstance(value, frozenset):
+                    value = sorted(map(repr, value))
+                parts.append(f"{module.__name__}.{name}={value!r}".encode('utf-8'))
+    return zlib.crc32(b'\0'.join(parts))
+
+
+SNAPSHOT_FORMAT = snapshot_format()
+
+# Снимок читается через отображение файла в память, а не копированием страниц в кэш SQLite
+MMAP_SIZE = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    created_at REAL NOT NULL,
+    cars TEXT NOT NULL,
+    format INTEGER NOT NULL,
+    indexed BLOB,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    hash TEXT NOT NULL,
+    cars TEXT NOT NULL,
+    links TEXT
+);
+"""
+
+
+class SnapshotStore:
+    """SQLite-хранилище последнего снимка каталога для теплого перезапуска.
+
+    Хранит объявления, время парсинга, готовые индексы снимка, а также
+    ETag/Last-Modified и результаты разбора каждой страницы источников.
+
+    Через него же снимок передается между процессами: лидер публикует каждый
+    новый снимок с очередной версией, остальные процессы читают его в режиме
+    только для чтения. База работает в режиме WAL, поэтому чтение не ждет записи
+    и всегда видит целиком либо старый, либо новый снимок.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+                # Базы, созданные до появления пагинации, получают колонку ссылок
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(pages)")}
+                if 'links' not in columns:
+                    conn.execute("ALTER TABLE pages ADD COLUMN links TEXT")
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(snapshot)")}
+                if 'version' not in columns:
+                    conn.execute("ALTER TABLE snapshot ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        finally:
+            conn.close()
+
+    def _connect(self, readonly=False):
+        if readonly:
+            conn = sqlite3.connect(pathlib.Path(self.path).resolve().as_uri() + '?mode=ro', uri=True, timeout=30)
+        else:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        return conn
+
+    def save(self, snapshot, pages=None, validators=None):
+        """Сохраняет снимок и состояние загрузки страниц одной транзакцией"""
+        cars = dump_listings(snapshot.cars)
+        indexed = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+
+        page_rows = []
+        for url, (content_hash, page_cars, links) in (pages or {}).items():
+            known = (validators or {}).get(url) or {}
+            # Валидаторы без результата разбора бесполезны: 304 нечем будет обработать
+            if known.get('hash') != content_hash:
+                known = {}
+            page_rows.append((
+                url,
+                known.get('etag'),
+                known.get('last_modified'),
+                content_hash,
+                dump_listings(page_cars),
+                json.dumps(links) if links is not None else None,
+            ))
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO snapshot (id, created_at, cars, format, indexed, version) "
+                        "VALUES (1, ?, ?, ?, ?, COALESCE((SELECT version FROM snapshot WHERE id = 1), 0) + 1)",
+                        (snapshot.created_at, cars, SNAPSHOT_FORMAT, indexed)
+                    )
+                    conn.execute("DELETE FROM pages")
+                    conn.executemany(
+                        "INSERT INTO pages (url, etag, last_modified, hash, cars, links) VALUES (?, ?, ?, ?, ?, ?)",
+                        page_rows
+                    )
+            finally:
+                conn.close()
+
+    def load_snapshot(self):
+        """Последний сохраненный снимок или None"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT created_at, cars, format, indexed FROM snapshot WHERE id = 1").fetchone()
+            finally:
+                conn.close()
+
+        if row is None:
+            return None
+        return self._unpack(*row)
+
+    def load_if_newer(self, version):
+        """(версия, снимок), если опубликован снимок новее version, иначе (version, None).
+
+        Снимок читается только для чтения и целиком, вместе с готовыми индексами,
+        так что разбирать страницы и строить индексы заново не нужно.
+        """
+        conn = self._connect(readonly=True)
+        try:
+            row = conn.execute(
+                "SELECT version, created_at, cars, format, indexed FROM snapshot WHERE id = 1 AND version > ?",
+                (version,)
+            ).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return version, None
+        return row[0], self._unpack(*row[1:])
+
+    def _unpack(self, created_at, cars, snapshot_format, indexed):
+        if snapshot_format == SNAPSHOT_FORMAT and indexed:
+            try:
+                return pickle.loads(indexed)
+            except Exception as e:
+                logger.warning(f"Не удалось восстановить индексы снимка, строим заново: {e}")
+        return CatalogSnapshot(load_listings(cars), created_at=created_at)
+
+    def load_pages(self):
+        """Возвращает (pages, validators) в формате parsers.parsed_pages и HttpClient"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT url, etag, last_modified, hash, cars, links FROM pages").fetchall()
+            finally:
+                conn.close()
+
+        pages = {}
+        validators = {}
+        for url, etag, last_modified, content_hash, cars, links in rows:
+            # Ссылки на другие страницы неизвестны - такая страница будет загружена заново
+            pages[url] = (content_hash, load_listings(cars), json.loads(links) if links is not None else None)
+            validators[url] = {'etag': etag, 'last_modified': last_modified, 'hash': content_hash}
+        return pages, validators
@@ -0,0 +1,230 @@
+import html
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from catalog import brand_key, diff_snapshots, listing_key
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Подписка на все автомобили хранится как категория ALL_CATEGORIES
+ALL_CATEGORIES = 'all'
+
+# Сколько объявлений каждого вида показывать в одном уведомлении
+MAX_EVENTS_PER_KIND = 15
+
+
+class SubscriptionStore:
+    """Подписки пользователей на марки и категории.
+
+    Хранятся в SQLite, для рассылки держится индекс в памяти:
+    (kind, value) -> множество chat_id.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS subscriptions ("
+                    "chat_id INTEGER NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, "
+                    "PRIMARY KEY (chat_id, kind, value))"
+                )
+        finally:
+            conn.close()
+        self.reload()
+
+    def reload(self):
+        """Перечитывает индекс из базы: подписки могли добавить другие процессы бота"""
+        index = {}
+        conn = self._connect()
+        try:
+            for chat_id, kind, value in conn.execute("SELECT chat_id, kind, value FROM subscriptions"):
+                index.setdefault((kind, value), set()).add(chat_id)
+        finally:
+            conn.close()
+        with self._lock:
+            self._index = index
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, sql, params):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    def subscribe(self, chat_id, kind, value):
+        with self._lock:
+            self._execute("INSERT OR IGNORE INTO subscriptions (chat_id, kind, value) VALUES (?, ?, ?)", (chat_id, kind, value))
+            self._index.setdefault((kind, value), set()).add(chat_id)
+
+    def unsubscribe(self, chat_id, kind, value):
+        with self._lock:
+            self._execute("DELETE FROM subscriptions WHERE chat_id = ? AND kind = ? AND value = ?", (chat_id, kind, value))
+            chats = self._index.get((kind, value))
+            if chats:
+                chats.discard(chat_id)
+
+    def unsubscribe_all(self, chat_id):
+        with self._lock:
+            self._execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+            for chats in self._index.values():
+                chats.discard(chat_id)
+
+    def for_chat(self, chat_id):
+        """Список (kind, value) подписок чата"""
+        with self._lock:
+            return sorted(key for key, chats in self._index.items() if chat_id in chats)
+
+    def subscribers(self, kind, value):
+        with self._lock:
+            return set(self._index.get((kind, value), ()))
+
+    @property
+    def count(self):
+        with self._lock:
+            return sum(len(chats) for chats in self._index.values())
+
+
+def _car_line(car):
+    return f"• <b>{html.escape(car['name'])}</b> - {html.escape(car['price'])}"
+
+
+def format_changes(added, removed, price_changed):
+    """Текст уведомления об изменениях каталога для одного пользователя"""
+    parts = ["🔔 <b>Обновления каталога по вашим подпискам</b>"]
+
+    def section(title, lines):
+        shown = lines[:MAX_EVENTS_PER_KIND]
+        text = f"{title}\n" + "\n".join(shown)
+        if len(lines) > len(shown):
+            text += f"\n...и еще {len(lines) - len(shown)}"
+        parts.append(text)
+
+    if added:
+        section("🆕 <b>Новые поступления:</b>", [_car_line(car) for car in added])
+    if price_changed:
+        section("💰 <b>Изменилась цена:</b>", [
+            f"• <b>{html.escape(new['name'])}</b>: {html.escape(old['price'])} → {html.escape(new['price'])}"
+            for old, new in price_changed
+        ])
+    if removed:
+        section("❌ <b>Сняты с продажи:</b>", [_car_line(car) for car in removed])
+
+    return "\n\n".join(parts)
+
+
+class ChangeNotifier:
+    """Сравнивает каждый новый снимок с предыдущим и рассылает изменения подписчикам.
+
+    Рассылка идет в отдельном потоке через общий TelegramSender; собственное
+    ведро токенов оставляет часть общего лимита Telegram для ответов пользователям.
+    """
+
+    def __init__(self, subscriptions, sender, broadcast_rate=20):
+        self.subscriptions = subscriptions
+        self.sender = sender
+        self.bucket = TokenBucket(broadcast_rate, broadcast_rate)
+        self._previous = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self.sent = 0
+
+    def prime(self, snapshot):
+        """Задает снимок, с которым сравнивается первое обновление"""
+        if self._previous is None:
+            self._previous = snapshot
+
+    def on_refresh(self, snapshot):
+        """Обработчик обновления каталога"""
+        previous, self._previous = self._previous, snapshot
+        if previous is None:
+            return
+
+        diff = diff_snapshots(previous, snapshot)
+        if diff:
+            logger.info(
+                f"Изменения каталога: +{len(diff.added)}, -{len(diff.removed)}, "
+                f"цена {len(diff.price_changed)}"
+            )
+            self._queue.put(diff)
+
+    def follow(self, snapshot):
+        """Снимок, полученный от процесса-лидера: изменения по нему рассылает лидер"""
+        self._previous = snapshot
+
+    def _targets(self, car):
+        chats = self.subscriptions.subscribers('brand', brand_key(car['brand']))
+        chats.update(self.subscriptions.subscribers('category', car.get('category')))
+        chats.update(self.subscriptions.subscribers('category', ALL_CATEGORIES))
+        return chats
+
+    def plan(self, diff):
+        """Группирует события по чатам: chat_id -> (added, removed, price_changed)"""
+        per_chat = {}
+
+        def add(kind, car, event):
+            for chat_id in self._targets(car):
+                events = per_chat.setdefault(chat_id, ([], [], [], set()))
+                key = (kind, listing_key(car))
+                # Подписчик марки и категории получает событие один раз
+                if key not in events[3]:
+                    events[3].add(key)
+                    events[kind].append(event)
+
+        for car in diff.added:
+            add(0, car, car)
+        for car in diff.removed:
+            add(1, car, car)
+        for old, new in diff.price_changed:
+            add(2, new, (old, new))
+
+        return {chat_id: events[:3] for chat_id, events in per_chat.items()}
+
+    def _on_sent(self, chat_id, future):
+        from telebot.apihelper import ApiTelegramException
+
+        # Прочие ошибки отправки записывает в лог сама очередь
+        error = future.exception()
+        if isinstance(error, ApiTelegramException) and error.error_code == 403:
+            # Пользователь заблокировал бота - рассылать ему больше нечего
+            logger.info(f"Чат {chat_id} недоступен, удаляем подписки")
+            self.subscriptions.unsubscribe_all(chat_id)
+
+    def _broadcast(self, diff):
+        self.subscriptions.reload()
+        for chat_id, (added, removed, price_changed) in self.plan(diff).items():
+            self.bucket.consume()
+            text = format_changes(added, removed, price_changed)
+            future = self.sender.send_message(chat_id, text, disable_web_page_preview=True)
+            future.add_done_callback(lambda f, chat_id=chat_id: self._on_sent(chat_id, f))
+            self.sent += 1
+
+    def _run(self):
+        while True:
+            diff = self._queue.get()
+            try:
+                self._broadcast(diff)
+            except Exception as e:
+                logger.error(f"Ошибка рассылки изменений: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='change-notifier')
+        self._thread.daemon = True
+        self._thread.start()